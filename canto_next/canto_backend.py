@@ -10,14 +10,17 @@
 
 CANTO_PROTOCOL_VERSION = 0.9
 
-from .feed import allfeeds, wlock_all, stop_feeds, rlock_feed_objs, runlock_feed_objs
+from .feed import allfeeds, wlock_all, stop_feeds, rlock_feed_objs, runlock_feed_objs,\
+        missing_attributes
 from .encoding import encoder
 from .server import CantoServer
 from .config import config, parse_locks, parse_unlocks
-from .storage import CantoShelf
+from .storage import storage_types, CantoSyncScheduler
 from .fetch import CantoFetch
 from .hooks import on_hook, call_hook
 from .tag import alltags
+from .ids import allids
+from .search import allsearch
 from .transform import eval_transform
 from .plugins import PluginHandler, Plugin, try_plugins, set_program
 from .rwlock import alllocks, write_lock, read_lock
@@ -25,6 +28,8 @@ from .locks import *
 
 import traceback
 import logging
+import hashlib
+import json
 import signal
 import fcntl
 import errno
@@ -75,10 +80,13 @@ class CantoBackend(PluginHandler, CantoServer):
         self.socket_transforms = {}
 
         self.shelf = None
+        self.storage = "gzip"
+        self.sync_scheduler = None
+        self.tags_complete = False
 
         # No bad arguments.
         version = "canto-daemon " + REPLACE_VERSION + " " + GIT_HASH
-        optl = self.common_args("nhc:",["nofetch","help","cache="], version)
+        optl = self.common_args("nhc:",["nofetch","help","cache=","storage="], version)
         if optl == -1:
             sys.exit(-1)
 
@@ -272,6 +280,26 @@ class CantoBackend(PluginHandler, CantoServer):
 
         self.write(socket, "LISTTAGS", r)
 
+    # TAGCOUNTS [ tags ] -> { tag : { "total" : n, state : n, ... } }
+
+    # Counts of the items in each tag, and of those items in each canto-state
+    # (i.e. "read"), from the counts alltags keeps up to date so we don't
+    # have to send every item and its state just to count them. No tags
+    # means all tags.
+
+    @read_lock(feed_lock)
+    @read_lock(tag_lock)
+    def cmd_tagcounts(self, socket, args):
+        if not args:
+            args = [ "maintag:" + feed.name for feed in allfeeds.get_feeds() ]
+            args += [ t for t in alltags.get_tags() if t not in args ]
+
+        r = {}
+        for tag in args:
+            r[tag] = alltags.tag_counts(tag)
+
+        self.write(socket, "TAGCOUNTS", r)
+
     # LISTTRANSFORMS -> [ { "name" : " " } for all defined filters ]
 
     @read_lock(config_lock)
@@ -349,8 +377,9 @@ class CantoBackend(PluginHandler, CantoServer):
         socktran_lock.acquire_read()
         try:
 
+            attrs = {}
             for filt in self.socket_transforms[socket]:
-                tag = self.socket_transforms[socket][filt](tag)
+                tag = self.socket_transforms[socket][filt](tag, attrs)
         finally:
             socktran_lock.release_read()
             runlock_feed_objs(feeds)
@@ -371,32 +400,52 @@ class CantoBackend(PluginHandler, CantoServer):
             if len(items) == 0:
                 self.write(socket, "ITEMS", { tag : [] })
             else:
+                strings = [ allids.to_string(id) for id in items ]
+
                 attr_req = {}
                 if socket in self.autoattr:
                     for id in items:
                         attr_req[id] = self.autoattr[socket][:]
-                    attr_list.append(attr_req)
+                    attr_list.append((attr_req, dict(zip(items, strings))))
 
-                self.write(socket, "ITEMS", { tag : items })
+                self.write(socket, "ITEMS", { tag : strings })
 
             self.write(socket, "ITEMSDONE", {})
 
-            for attr_req in attr_list:
-                self.cmd_attributes(socket, attr_req)
+            for attr_req, id_strings in attr_list:
+                self.write_attributes(socket, attr_req, id_strings)
 
     # ATTRIBUTES { id : [ attribs .. ] .. } ->
     # { id : { attribute : value } ... }
 
+    def cmd_attributes(self, socket, args):
+        handles, strings = allids.from_protocol(args)
+
+        unknown = {}
+        if len(handles) != len(args):
+            known = set(strings.values())
+            for s in args:
+                if s not in known:
+                    unknown[s] = missing_attributes(args[s])
+
+        self.write_attributes(socket, handles, strings, unknown)
+
+    # Write ATTRIBUTES for { handle : [ attribs .. ] }, keyed by the protocol
+    # strings in strings, along with any already known results.
+
     # Hold feed_lock so that get_attributes won't fail on a missing feed, but
     # items_to_feeds can still throw an exception if attributes requests come
     # in for items from removed feeds.
 
     @read_lock(feed_lock)
-    def cmd_attributes(self, socket, args):
-        ret = {}
+    def write_attributes(self, socket, args, strings, ret=None):
+        if ret == None:
+            ret = {}
         feeds = allfeeds.items_to_feeds(list(args.keys()))
         for f in feeds:
-            ret.update(f.get_attributes(feeds[f], args))
+            attrs = f.get_attributes(feeds[f], args)
+            for id in attrs:
+                ret[strings[id]] = attrs[id]
 
         self.write(socket, "ATTRIBUTES", ret)
 
@@ -405,6 +454,7 @@ class CantoBackend(PluginHandler, CantoServer):
     @read_lock(feed_lock)
     @write_lock(tag_lock)
     def cmd_setattributes(self, socket, args):
+        args, strings = allids.from_protocol(args)
 
         feeds = allfeeds.items_to_feeds(list(args.keys()))
         for f in feeds:
@@ -414,6 +464,16 @@ class CantoBackend(PluginHandler, CantoServer):
         for t in tags:
             call_hook("daemon_tag_change", [ t ])
 
+    # SEARCH [ terms, ... ] -> { terms : [ ids ] .. }
+
+    # Items with all of the words in terms in their title or summary.
+
+    def cmd_search(self, socket, args):
+        ret = {}
+        for terms in args:
+            ret[terms] = [ allids.to_string(id) for id in allsearch.search(terms) ]
+        self.write(socket, "SEARCH", ret)
+
     # CONFIGS [ "top_sec", ... ] -> { "top_sec" : full_value }
 
     # Internally, called only by functions that hold read or write on
@@ -553,11 +613,39 @@ class CantoBackend(PluginHandler, CantoServer):
         if cb:
             cb(r)
 
+    # Tags are built from the feed content, the configuration (tag settings
+    # and transforms) and any plugins that edit items as they're indexed. If
+    # none of them have changed, neither have the tags.
+
+    def tags_stamp(self):
+        conf = json.dumps(config.json, sort_keys=True)
+
+        plugin_attrs = set()
+        for feed in allfeeds.get_feeds():
+            plugin_attrs.update(feed.plugin_attrs.keys())
+
+        return { "modified" : self.shelf["control"]["canto-modified"],
+                 "config" : hashlib.sha1(conf.encode("UTF-8")).hexdigest(),
+                 "plugins" : sorted(plugin_attrs) }
+
     def run(self):
 
-        # Start fetch threads to load from disk. No need for locking as we
-        # haven't started any threads yet
-        self.fetch.fetch(True, True)
+        # If we saved tags and the search index on the way down, and nothing's
+        # changed since, we can just use them. Otherwise start fetch threads
+        # to load from disk. No need for locking as we haven't started any
+        # threads yet.
+
+        stamp = self.tags_stamp()
+        tags_loaded = alltags.load(self.tags_path, stamp)
+        search_loaded = allsearch.load(self.search_path, stamp)
+
+        if tags_loaded and search_loaded:
+            self.tags_complete = True
+        else:
+            self.fetch.fetch(True, True)
+
+        self.sync_scheduler = CantoSyncScheduler(self.shelf)
+        self.sync_scheduler.start()
 
         log.debug("Beginning to serve...")
         call_hook("daemon_serving", [])
@@ -566,12 +654,11 @@ class CantoBackend(PluginHandler, CantoServer):
                 log.info("Interrupted. Exiting.")
                 return
 
-            # Clean up any dead connection threads.
-            self.no_dead_conns()
-
             # Clean up any threads done updating.
             self.fetch.reap()
 
+            self.check_tags_complete()
+
             # Check whether feeds need to be updated and fetch
             # them if necessary.
 
@@ -585,6 +672,28 @@ class CantoBackend(PluginHandler, CantoServer):
 
             time.sleep(1)
 
+    # Once every feed has been indexed, the tags reflect the disk. They can be
+    # thrown away again (config.reset(), sync-rsync), and until every feed has
+    # been indexed again, anything we saved is no better than the tags we'd
+    # save on the way down, so get rid of it.
+
+    def check_tags_complete(self):
+        complete = alltags.complete(list(allfeeds.feeds.keys()))
+
+        if self.tags_complete and not complete:
+            log.debug("Tags incomplete, discarding saved tags")
+            self.remove_saved_tags()
+
+        self.tags_complete = complete
+
+    def remove_saved_tags(self):
+        for path in [ self.tags_path, self.search_path ]:
+            try:
+                if os.path.exists(path):
+                    os.unlink(path)
+            except Exception as e:
+                log.error("Failed to remove %s: %s" % (path, e))
+
     # Shutdown cleanly
 
     def cleanup(self):
@@ -593,10 +702,30 @@ class CantoBackend(PluginHandler, CantoServer):
 
         stop_feeds()
 
+        # Stop scheduled syncs, we'll do the final one on close.
+
+        if self.sync_scheduler:
+            self.sync_scheduler.stop()
+
         # Grab locks to keep any other write usage from happening.
 
         wlock_all()
 
+        # Save the tags and search index, as long as they were done being
+        # built from disk.
+
+        self.check_tags_complete()
+
+        if self.tags_complete:
+            for obj, path in [ (alltags, self.tags_path),
+                    (allsearch, self.search_path) ]:
+                try:
+                    obj.save(path, self.tags_stamp())
+                except Exception as e:
+                    log.error("Failed to save %s: %s" % (path, e))
+        else:
+            self.remove_saved_tags()
+
         self.shelf.close()
 
         call_hook("daemon_exit", [])
@@ -631,6 +760,8 @@ class CantoBackend(PluginHandler, CantoServer):
         print("\t-v/\t\tVerbose logging (for debug)")
         print("\t-D/--dir <dir>\tSet configuration directory.")
         print("\t-n/--nofetch\tJust serve content, don't fetch new content.")
+        print("\t--storage <type>\tStorage engine for feed content (%s)" %\
+                ", ".join(sorted(storage_types.keys())))
         print("\n\nPlugin control\n")
         print("\t--noplugins\t\t\t\tDisable plugins")
         print("\t--enableplugins 'plugin1 plugin2...'\tEnable single plugins (overrides --noplugins)")
@@ -648,6 +779,11 @@ class CantoBackend(PluginHandler, CantoServer):
             elif opt in ['-h', '--help']:
                 self.print_help()
                 sys.exit(0)
+            elif opt in ["--storage"]:
+                if arg not in storage_types:
+                    log.error("Error: Unknown storage type %s" % arg)
+                    return -1
+                self.storage = arg
         return 0
 
     def sig_int(self, a, b):
@@ -698,6 +834,9 @@ class CantoBackend(PluginHandler, CantoServer):
                 log.info("Lock writer (thread %s):" % (lock.writer_id,))
                 log.info(''.join(writer_stack))
 
+        if self.sync_scheduler:
+            log.info("\n\nSYNC: %s" % self.sync_scheduler.stats())
+
         self.shelf.sync()
         gc.collect()
 
@@ -732,7 +871,7 @@ class CantoBackend(PluginHandler, CantoServer):
         return self.ensure_files()
 
     def ensure_files(self):
-        for f in [ "feeds", "conf", "daemon-log", "pid"]:
+        for f in [ "feeds", "conf", "daemon-log", "pid", "tags", "search"]:
             p = self.conf_dir + "/" + f
             if os.path.exists(p):
                 if not os.path.isfile(p):
@@ -751,6 +890,8 @@ class CantoBackend(PluginHandler, CantoServer):
         self.pid_path = self.conf_dir + "/pid"
         self.log_path = self.conf_dir + "/daemon-log"
         self.conf_path = self.conf_dir + "/conf"
+        self.tags_path = self.conf_dir + "/tags"
+        self.search_path = self.conf_dir + "/search"
 
         return None
 
@@ -784,7 +925,8 @@ class CantoBackend(PluginHandler, CantoServer):
     # fatal and handled lower in CantoShelf.
 
     def get_storage(self):
-        self.shelf = CantoShelf(self.feed_path)
+        log.info("storage = %s" % self.storage)
+        self.shelf = storage_types[self.storage](self.feed_path)
 
     # Bring up config, the only errors possible at this point will
     # be fatal and handled lower in CantoConfig.
@@ -12,6 +12,8 @@ from .tag import alltags
 from .rwlock import RWLock, read_lock, write_lock
 from .locks import feed_lock, tag_lock
 from .hooks import call_hook
+from .ids import allids
+from .search import allsearch, SEARCH_ATTRIBUTES
 
 import traceback
 import logging
@@ -20,11 +22,34 @@ import time
 
 log = logging.getLogger("FEED")
 
+# Accepts an id handle (see ids.py), a protocol id string, or an already
+# decoded dict.
+
 def dict_id(i):
+    if type(i) == int:
+        URL, ID = allids.key(i)
+        return { "URL" : URL, "ID" : ID }
     if type(i) == dict:
         return i
     return json.loads(i)
 
+# Same, but just the (URL, ID) pair, without decoding handles into dicts.
+
+def id_key(i):
+    if type(i) == int:
+        return allids.key(i)
+    d_i = dict_id(i)
+    return (d_i["URL"], d_i["ID"])
+
+# Placeholder attributes for an item that can't be found.
+
+def missing_attributes(attributes):
+    r = {}
+    for a in attributes:
+        r[a] = ""
+    r["title"] = "???"
+    return r
+
 class CantoFeeds():
     def __init__(self):
         self.order = []
@@ -55,12 +80,12 @@ class CantoFeeds():
     def items_to_feeds(self, items):
         f = {}
         for i in items:
-            d_i = dict_id(i)
+            URL = id_key(i)[0]
 
-            if d_i["URL"] in self.feeds:
-                feed = self.feeds[d_i["URL"]]
+            if URL in self.feeds:
+                feed = self.feeds[URL]
             else:
-                raise Exception("Can't find feed: %s" % d_i["URL"])
+                raise Exception("Can't find feed: %s" % URL)
 
             if feed in f:
                 f[feed].append(i)
@@ -187,19 +212,18 @@ class CantoFeed(PluginHandler):
     def get_attributes(self, items, attributes):
         r = {}
 
-        d = self.shelf[self.URL]
+        args = [ (id_key(item)[1], item, attributes[item]) for item in items ]
 
-        args = [ (dict_id(item)["ID"], item, attributes[item]) for item in items ]
-        args.sort()
+        needed = set()
+        for item, full_id, needed_attrs in args:
+            needed.update(needed_attrs)
+        if "description" in needed:
+            needed.add("summary")
 
-        got = [ (item["id"], item) for item in d["entries"] ]
-        got.sort()
+        got = self._get_entries([ arg[0] for arg in args ], needed)
 
         for item, full_id, needed_attrs in args:
-            while got and item > got[0][0]:
-                got.pop(0)
-
-            if got and got[0][0] == item:
+            if item in got:
                 attrs = {}
                 for a in needed_attrs:
                     if a == "description":
@@ -207,18 +231,14 @@ class CantoFeed(PluginHandler):
                     else:
                         real = a
 
-                    if real in got[0][1]:
-                        attrs[a] = got[0][1][real]
+                    if real in got[item]:
+                        attrs[a] = got[item][real]
                     else:
                         attrs[a] = ""
                 r[full_id] = attrs
-                got.pop(0)
             else:
                 log.warn("item not found: %s" % item)
-                r[full_id] = {}
-                for a in needed_attrs:
-                    r[full_id][a] = ""
-                r[full_id]["title"] = "???"
+                r[full_id] = missing_attributes(needed_attrs)
         return r
 
     # Given an ID and a dict of attributes, update the disk.
@@ -226,32 +246,53 @@ class CantoFeed(PluginHandler):
 
         self.lock.acquire_write()
 
-        d = self.shelf[self.URL]
-
-        items_to_remove = []
-        tags_to_add = []
-
+        updates = {}
         for item in items:
-            d_id = dict_id(item)["ID"]
+            updates[id_key(item)[1]] = attributes[item]
 
-            for d_item in d["entries"]:
-                if d_id != d_item["id"]:
-                    continue
-                for a in attributes[item]:
-                    d_item[a] = attributes[item][a]
+        items_to_remove = self._set_entry_attributes(updates)
+        tags_to_add = self._tag(items_to_remove)
 
-                items_to_remove.append(d_item)
-                tags_to_add += self._tag([d_item])
+        searched = [ id for id in updates if\
+                [ a for a in SEARCH_ATTRIBUTES if a in updates[id] ] ]
+        if searched:
+            self._search_index_ids(searched)
 
-        self.shelf[self.URL] = d
-        self.shelf.update_umod()
+        if hasattr(self.shelf, "update_umod"):
+            self.shelf.update_umod()
 
         self.lock.release_write()
 
         self._retag(items_to_remove, tags_to_add, [])
 
+    # Shelves index entries by id (see CantoShelf.get_entries). A plain dict,
+    # as used in the tests, is just searched.
+
+    def _get_entries(self, ids, attributes=None):
+        if hasattr(self.shelf, "get_entries"):
+            return self.shelf.get_entries(self.URL, ids, attributes)
+
+        if self.URL not in self.shelf:
+            return {}
+
+        ids = set(ids)
+        r = {}
+        for entry in self.shelf[self.URL]["entries"]:
+            if entry["id"] in ids and entry["id"] not in r:
+                r[entry["id"]] = entry
+        return r
+
+    def _set_entry_attributes(self, attributes):
+        if hasattr(self.shelf, "set_entry_attributes"):
+            return self.shelf.set_entry_attributes(self.URL, attributes)
+
+        entries = self._get_entries(list(attributes.keys()))
+        for id in entries:
+            entries[id].update(attributes[id])
+        return list(entries.values())
+
     def _item_id(self, item):
-        return json.dumps({ "URL" : self.URL, "ID" : item["id"] })
+        return allids.intern(self.URL, item["id"])
 
     def _tag(self, items):
         tags_to_add = []
@@ -269,6 +310,31 @@ class CantoFeed(PluginHandler):
         feed_lock.acquire_read()
         tag_lock.acquire_write()
 
+        self._set_states(items_to_remove, [])
+        self._apply_retag(items_to_remove, tags_to_add, tags_to_remove)
+        alltags.do_tag_changes()
+
+        tag_lock.release_write()
+        feed_lock.release_read()
+
+    # Record the canto-state of items, and forget the state of the gone items
+    # (see CantoTags.state_items).
+
+    # Must be called with tag_lock held with write.
+
+    def _set_states(self, items, gone):
+        for item in items:
+            if "canto-state" in item and type(item["canto-state"]) == list:
+                alltags.set_item_states(self._item_id(item), item["canto-state"])
+            else:
+                alltags.set_item_states(self._item_id(item), [])
+
+        for item in gone:
+            alltags.set_item_states(self._item_id(item), [])
+
+    # Must be called with tag_lock held with write.
+
+    def _apply_retag(self, items_to_remove, tags_to_add, tags_to_remove):
         for item in items_to_remove:
             alltags.remove_id(self._item_id(item))
 
@@ -278,11 +344,138 @@ class CantoFeed(PluginHandler):
         for item, tag in tags_to_remove:
             alltags.remove_tag(self._item_id(item), tag)
 
-        alltags.do_tag_changes()
+        # Keep our record of what we've put in tags up to date.
+
+        members = alltags.feed_members.get(self.URL)
+        if members != None:
+            for item in items_to_remove:
+                item_id = self._item_id(item)
+                for tag in members:
+                    members[tag].pop(item_id, None)
+
+            for item, tag in tags_to_add:
+                item_id = self._item_id(item)
+                for t in alltags.tag_and_extras(tag):
+                    members.setdefault(t, {})
+                    if item_id not in members[t]:
+                        members[t][item_id] = None
+
+            for item, tag in tags_to_remove:
+                members.get(tag, {}).pop(self._item_id(item), None)
+
+    # Whether the shelf keeps attr for old entries. Shelves that keep entry
+    # content on disk only hand back metadata, so anything else is missing
+    # from old entries whether it changed or not.
+
+    def _resident(self, attr):
+        if hasattr(self.shelf, "is_resident"):
+            return self.shelf.is_resident(attr)
+        return True
+
+    def _content_changed(self, olditem, item):
+        for key in item:
+            if key == "canto_update" or not self._resident(key):
+                continue
+            if key not in olditem or olditem[key] != item[key]:
+                return True
+
+        for key in olditem:
+            if key != "canto_update" and key not in item:
+                return True
+
+        return False
+
+    # Retag after index. Instead of removing all of the old items from every
+    # tag and adding them back, we compare the ids we want in each tag to the
+    # ones we put there last time. A tag has only changed if those ids, or
+    # their order, changed, or if one of those items' content changed (which
+    # could change the result of the tag's transforms).
+
+    # Changed tags are updated the same way a full retag would, removing all
+    # of our old items and appending the wanted ones in order.
+
+    # If we don't know what we put in the tags last time (first index, or the
+    # tags have been cleared), fall back to a full retag.
+
+    # Items in touched (by id) count as changed, even if they compare equal to
+    # the old entries (see _marks).
+
+    def _retag_index(self, old_entries, new_entries, remove_items, tags_to_add, tags_to_remove, touched=set()):
+        feed_lock.acquire_read()
+        tag_lock.acquire_write()
+
+        wanted = {}
+        for item, tag in tags_to_add:
+            item_id = self._item_id(item)
+            for t in alltags.tag_and_extras(tag):
+                wanted.setdefault(t, {})
+                if item_id not in wanted[t]:
+                    wanted[t][item_id] = None
+
+        for item, tag in tags_to_remove:
+            wanted.get(tag, {}).pop(self._item_id(item), None)
+
+        new_ids = set([ item["id"] for item in new_entries ])
+        self._set_states(new_entries, [ olditem for olditem in old_entries\
+                if olditem["id"] not in new_ids ])
+
+        gone = [ self._item_id(item) for item in old_entries + remove_items\
+                if item["id"] not in new_ids ]
+
+        previous = alltags.feed_members.get(self.URL)
+
+        if previous == None:
+            self._apply_retag(old_entries + remove_items, tags_to_add, tags_to_remove)
+            alltags.feed_members[self.URL] = wanted
+            alltags.do_tag_changes()
+            self._release(gone)
+
+            tag_lock.release_write()
+            feed_lock.release_read()
+            return
+
+        old_items = dict([ (olditem["id"], olditem) for olditem in old_entries ])
+
+        changed_items = set()
+        for item in new_entries:
+            if item["id"] not in old_items or item["id"] in touched or\
+                    self._content_changed(old_items[item["id"]], item):
+                changed_items.add(self._item_id(item))
+
+        old_ids = [ self._item_id(item) for item in old_entries + remove_items ]
+
+        tags = list(previous.keys())
+        tags += [ tag for tag in wanted if tag not in previous ]
+
+        for tag in tags:
+            if tag in previous and tag in wanted:
+                if list(previous[tag].keys()) == list(wanted[tag].keys()) and\
+                        not changed_items.intersection(wanted[tag]):
+                    continue
+            elif tag not in wanted:
+                if not previous[tag]:
+                    continue
+
+            log.debug("%s changed in %s", self.name, tag)
+            alltags.update_tag(tag, old_ids, list(wanted.get(tag, {}).keys()))
+
+        alltags.feed_members[self.URL] = wanted
+
+        # Nothing changed, nothing to do.
+        if alltags.changed_tags:
+            alltags.do_tag_changes()
+
+        self._release(gone)
 
         tag_lock.release_write()
         feed_lock.release_read()
 
+    # Release the handles of items that have left the feed, unless they're
+    # somehow still tagged.
+
+    def _release(self, ids):
+        allids.release([ id for id in ids if id not in alltags.item_tags ])
+
     def _keep_olditem(self, olditem):
         ref_time = time.time()
 
@@ -306,32 +499,16 @@ class CantoFeed(PluginHandler):
             return False
         return True
 
-    # Re-index contents
-    # If we have update_contents, use that
-    # If not, at least populate self.items from disk.
-
-    # MUST GUARANTEE self.items is in same order as entries on disk.
-
-    def index(self, update_contents):
-
-        # If the daemon is shutting down, discard this update.
-
-        if self.stopped:
-            return
-
-        self.lock.acquire_write()
-
-        if self.URL not in self.shelf:
-            # Stub empty feed
-            log.debug("Previous content not found for %s.", self.URL)
-            old_contents = {"entries" : []}
-        else:
-            old_contents = self.shelf[self.URL]
-            log.debug("Fetched previous content for %s.", self.URL)
+    # Merge freshly fetched entries with the old ones. The result is the new
+    # entries, in feed order, followed by old entries that should be kept, in
+    # their original order. Entries are matched by id through a dict, so this
+    # is linear in the number of entries.
 
+    def _merge(self, update_contents, old_contents):
         new_entries = []
+        new_ids = set()
 
-        for i, item in enumerate(update_contents["entries"]):
+        for item in update_contents["entries"]:
 
             # Update canto_update only for freshly seen items.
             item["canto_update"] = update_contents["canto_update"]
@@ -346,72 +523,123 @@ class CantoFeed(PluginHandler):
                     log.error("Unable to uniquely ID item: %s" % item)
                     continue
 
-            new_entries.append((i, item["id"], item))
+            # Remove duplicates, first one wins
+            if item["id"] in new_ids:
+                continue
 
-        # Sort by string id
-        new_entries.sort(key=lambda x: x[1])
+            new_ids.add(item["id"])
+            new_entries.append(item)
 
-        # Remove duplicates
-        last_id = ""
-        for x in new_entries[:]:
-            if x[1] == last_id:
-                new_entries.remove(x)
-            else:
-                last_id = x[1]
+        old_entries = {}
+        for olditem in old_contents["entries"]:
+            if olditem["id"] not in old_entries:
+                old_entries[olditem["id"]] = olditem
+
+        for item in new_entries:
+
+            # new entry and old entry match, move content over
+
+            if item["id"] in old_entries:
+                olditem = old_entries[item["id"]]
+                for key in olditem:
+                    if key == "canto_update":
+                        continue
+                    elif key.startswith("canto"):
+                        item[key] = olditem[key]
 
-        old_entries = [ (i, item["id"], item) for (i, item) in enumerate(old_contents["entries"])]
+            # new entry is really new, tell everyone
 
-        old_entries.sort(key=lambda x: x[1])
+            else:
+                call_hook("daemon_new_item", [self, item])
+
+        # If there are no new entries, keep everything.
 
         keep_all = new_entries == []
 
         kept_entries = []
+        for olditem in old_contents["entries"]:
 
-        for x in new_entries:
+            # Merged into a new entry
 
-            # old_entry is really old, see if we should keep or discard
+            if olditem["id"] in new_ids and old_entries[olditem["id"]] is olditem:
+                continue
 
-            while old_entries and x[1] > old_entries[0][1]:
-                if keep_all or self._keep_olditem(old_entries[0][2]):
-                    kept_entries.append(old_entries.pop(0))
-                else:
-                    old_entries.pop(0)
+            if keep_all or self._keep_olditem(olditem):
+                kept_entries.append(olditem)
 
-            # new entry and old entry match, move content over
+        return new_entries + kept_entries
 
-            if old_entries and x[1] == old_entries[0][1]:
-                olditem = old_entries.pop(0)[2]
-                for key in olditem:
-                    if key == "canto_update":
-                        continue
-                    elif key.startswith("canto"):
-                        x[2][key] = olditem[key]
+    # Copy the canto-* metadata (state, user tags...) of entries. Kept entries
+    # are the old entries themselves, and merged entries share their lists, so
+    # a plugin changing these in place would go unnoticed comparing old and
+    # new. Comparing against these copies catches it.
 
-            # new entry is really new, tell everyone
+    def _marks(self, entries):
+        marks = {}
+        for item in entries:
+            m = {}
+            for key in item:
+                if key.startswith("canto") and key != "canto_update":
+                    if type(item[key]) == list:
+                        m[key] = item[key][:]
+                    else:
+                        m[key] = item[key]
+            marks[item["id"]] = m
+        return marks
+
+    def _touched(self, marks, entries):
+        touched = set()
+        for item in entries:
+            if item["id"] not in marks:
+                continue
+            m = marks[item["id"]]
+            for key in set(m.keys()).union(item.keys()):
+                if key.startswith("canto") and key != "canto_update" and\
+                        m.get(key) != item.get(key):
+                    touched.add(item["id"])
+                    break
+        return touched
 
-            else:
-                call_hook("daemon_new_item", [self, x[2]])
+    # Re-index contents
+    # If we have update_contents, use that
+    # If not, at least populate self.items from disk.
 
-        # Resort lists by place, instead of string id
-        new_entries.sort()
-        old_entries.sort()
+    # MUST GUARANTEE self.items is in same order as entries on disk.
 
-        if keep_all:
-            kept_entries += old_entries
-        else:
-            for x in old_entries:
-                if self._keep_olditem(x[2]):
-                    kept_entries.append(x)
+    def index(self, update_contents):
+
+        # If the daemon is shutting down, discard this update.
+
+        if self.stopped:
+            return
+
+        self.lock.acquire_write()
 
-        kept_entries.sort()
-        new_entries += kept_entries
+        # Old entries may be changed in place (by _keep_olditem, or plugins), so
+        # they can't still be shared with a snapshot being written.
 
-        update_contents["entries"] = [ x[2] for x in new_entries ]
+        if hasattr(self.shelf, "unshare"):
+            self.shelf.unshare(self.URL)
+
+        if self.URL not in self.shelf:
+            # Stub empty feed
+            log.debug("Previous content not found for %s.", self.URL)
+            old_contents = {"entries" : []}
+        else:
+            old_contents = self.shelf[self.URL]
+            log.debug("Fetched previous content for %s.", self.URL)
+
+        update_contents["entries"] = self._merge(update_contents, old_contents)
 
         tags_to_add = self._tag(update_contents["entries"])
         tags_to_remove = []
         remove_items = []
 
+        plugins = [ attr for attr in self.plugin_attrs.keys()\
+                if attr.startswith("additems_") or attr.startswith("edit_") ]
+        if plugins:
+            marks = self._marks(update_contents["entries"])
+
         # Allow plugins to add items prior to running the editing functions
         # so that the editing functions are guaranteed the full list.
 
@@ -440,21 +668,85 @@ class CantoFeed(PluginHandler):
                 log.error("Error running feed editing plugin")
                 log.error(traceback.format_exc())
 
+        if plugins:
+            touched = self._touched(marks, update_contents["entries"])
+        else:
+            touched = set()
+
         if not self.stopped:
             # Commit the updates to disk.
 
             self.shelf[self.URL] = update_contents
 
+            self._search_index(old_contents["entries"],
+                    update_contents["entries"], remove_items)
+
             self.lock.release_write()
 
-            self._retag(old_contents["entries"] + remove_items, tags_to_add, tags_to_remove)
+            self._retag_index(old_contents["entries"], update_contents["entries"],
+                    remove_items, tags_to_add, tags_to_remove, touched)
         else:
             self.lock.release_write()
 
+    # Keep the search index up to date after index. Freshly fetched items are
+    # (re-)indexed if they're new or their content changed, old items that are
+    # still around only if they haven't been indexed yet (first run, or the
+    # index has been thrown away).
+
+    # Content the shelf doesn't keep for old entries (see _resident) can't be
+    # compared, so fresh items are always re-indexed on those shelves. They
+    # have all of their content, and re-indexing unchanged words is cheap.
+
+    # Must be called with self.lock held with write.
+
+    def _search_index(self, old_entries, new_entries, remove_items):
+        old_items = dict([ (olditem["id"], olditem) for olditem in old_entries ])
+        removed = set([ item["id"] for item in remove_items ])
+
+        fresh = {}
+        unindexed = []
+
+        for item in new_entries:
+            if item["id"] in removed:
+                continue
+
+            item_id = self._item_id(item)
+
+            if item["id"] in old_items and old_items[item["id"]] is item:
+                if not allsearch.has_item(item_id):
+                    unindexed.append(item["id"])
+            elif item["id"] not in old_items or\
+                    not allsearch.has_item(item_id) or\
+                    [ a for a in SEARCH_ATTRIBUTES if not self._resident(a) or\
+                    old_items[item["id"]].get(a) != item.get(a) ]:
+                fresh[item_id] = item
+
+        if fresh:
+            allsearch.add_items(fresh)
+        if unindexed:
+            self._search_index_ids(unindexed)
+
+        new_ids = set([ item["id"] for item in new_entries ])
+        gone = [ self._item_id(item) for item in old_entries + remove_items\
+                if item["id"] not in new_ids or item["id"] in removed ]
+        if gone:
+            allsearch.remove_items(gone)
+
+    # (Re-)index items by id, getting their content from the shelf.
+
+    def _search_index_ids(self, ids):
+        got = self._get_entries(ids, SEARCH_ATTRIBUTES)
+        allsearch.add_items(dict([ (allids.intern(self.URL, id), got[id])\
+                for id in got ]))
+
     def destroy(self):
         # Check for existence in case of delete quickly
         # after add.
 
         self.stopped = True
         if self.URL in self.shelf:
+            ids = [ self._item_id(item)\
+                    for item in self.shelf[self.URL]["entries"] ]
+            allsearch.remove_items(ids)
             del self.shelf[self.URL]
+            self._release(ids)
@@ -204,18 +204,15 @@ class CantoFetch():
                 log.debug("Deferring %s %s", feed, fromdisk)
                 self.deferred.append((feed, fromdisk))
 
+    # Syncing the results to disk is left to the sync scheduler.
+
     def reap(self, force=False):
-        work_done = False
         newthreads = []
 
         for thread, URL in self.threads:
             if not force and thread.is_alive():
                 newthreads.append((thread, URL))
                 continue
-            work_done = True
             thread.join()
 
         self.threads = newthreads
-
-        if work_done and self.threads == []:
-            self.shelf.sync()
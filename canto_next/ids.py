@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+from threading import Lock
+import time
+import json
+
+# Over the protocol, items are identified by a JSON string like
+# '{"URL": feed URL, "ID": entry id}'. Internally (in tags, transforms,
+# attribute requests) items are identified by small integer handles
+# instead, so we don't keep thousands of copies of those strings around and
+# don't have to parse them over and over to find out what feed an item
+# belongs to.
+
+# Handles are never reused. Once an item is gone (from its feed, and so every
+# tag), its handle is released and forgotten after RELEASE_DELAY, which gives
+# anything still holding it (i.e. a command in progress) time to finish with
+# it. The JSON strings are only rendered when an id goes out over the socket,
+# or to disk.
+
+RELEASE_DELAY = 60
+
+class CantoIds():
+    def __init__(self):
+        self.handles = {}
+        self.keys = {}
+        self.next_handle = 0
+        self.lock = Lock()
+
+        # { handle : time released }
+        self.released = {}
+
+    # Return the handle for this URL / ID pair, allocating one if necessary.
+
+    def intern(self, URL, ID):
+        key = (URL, ID)
+        handle = self.handles.get(key)
+        if handle == None or handle in self.released:
+            with self.lock:
+                handle = self.handles.get(key)
+                if handle == None:
+                    handle = self.next_handle
+                    self.next_handle += 1
+                    self.keys[handle] = key
+                    self.handles[key] = handle
+                else:
+                    self.released.pop(handle, None)
+        return handle
+
+    # Return the handle for this URL / ID pair, or None if it's unknown.
+
+    def lookup(self, URL, ID):
+        return self.handles.get((URL, ID))
+
+    # Release the handles of items that are gone, and forget the handles
+    # released long enough ago.
+
+    def release(self, handles):
+        now = time.time()
+
+        with self.lock:
+            for handle in handles:
+                if handle in self.keys:
+                    self.released[handle] = now
+
+            for handle, released in list(self.released.items()):
+                if now - released >= RELEASE_DELAY:
+                    del self.released[handle]
+                    del self.handles[self.keys.pop(handle)]
+
+    # Return (URL, ID) for a handle.
+
+    def key(self, handle):
+        return self.keys[handle]
+
+    # Protocol string <-> handle. If create isn't set, ids that don't already
+    # have a handle (i.e. items that are long gone) give None.
+
+    def from_string(self, s, create=True):
+        d = json.loads(s)
+        if create:
+            return self.intern(d["URL"], d["ID"])
+        return self.lookup(d["URL"], d["ID"])
+
+    def to_string(self, handle):
+        URL, ID = self.keys[handle]
+        return json.dumps({ "URL" : URL, "ID" : ID })
+
+    # Convert an incoming { string id : value } dict into { handle : value }
+    # and a map back to the strings the client used, so replies can be keyed
+    # the same way. Unknown ids are left out.
+
+    def from_protocol(self, args):
+        converted = {}
+        strings = {}
+        for s in args:
+            handle = self.from_string(s, False)
+            if handle == None:
+                continue
+            converted[handle] = args[s]
+            strings[handle] = s
+        return converted, strings
+
+allids = CantoIds()
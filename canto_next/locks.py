@@ -25,3 +25,4 @@ watch_lock = RWLock('watch_lock')
 attr_lock = RWLock('attr_lock')
 socktran_lock = RWLock('socktran_lock')
 hook_lock = RWLock('hook_look')
+search_lock = RWLock('search_lock')
@@ -22,6 +22,90 @@ import os
 
 log = logging.getLogger('SOCKET')
 
+# Messages are framed by an 8 byte size, followed by that many bytes of JSON.
+
+FRAME_HEADER = struct.Struct('!q')
+
+# Size of each connection's read buffer. Bigger messages get a bigger buffer
+# until they've been read.
+
+READ_BUFFER = 65536
+
+# Largest message we'll accept. The size comes straight off the wire, so
+# anything bigger (or negative) is treated as a broken connection rather than
+# something to allocate a buffer for.
+
+MAX_MESSAGE = 64 * 1024 * 1024
+
+# Bytes read from a single connection. Data is received straight into the
+# buffer (with recv_into), which can hold any number of frames, and complete
+# messages are decoded straight out of it, so nothing is built up with
+# repeated bytes concatenation.
+
+class CantoReadBuffer():
+    def __init__(self):
+        self.reset(READ_BUFFER)
+
+    def reset(self, size):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+        # Unconsumed data is buf[start:end]
+        self.start = 0
+        self.end = 0
+
+    # Return the next complete message, as a string, or None. A bad frame
+    # gives an empty message, which is taken as a hangup.
+
+    def message(self):
+        if self.end - self.start < FRAME_HEADER.size:
+            return None
+
+        size = FRAME_HEADER.unpack_from(self.buf, self.start)[0]
+        if size < 0 or size > MAX_MESSAGE:
+            log.error("Bad message size: %d", size)
+            return ""
+
+        begin = self.start + FRAME_HEADER.size
+        if self.end - begin < size:
+            return None
+
+        message = str(self.view[begin:begin + size], "UTF-8")
+
+        self.start = begin + size
+        if self.start == self.end:
+            if len(self.buf) > READ_BUFFER:
+                self.reset(READ_BUFFER)
+            else:
+                self.start = self.end = 0
+
+        return message
+
+    # Return a memoryview to recv_into.
+
+    def space(self):
+        need = FRAME_HEADER.size
+        if self.end - self.start >= need:
+            size = FRAME_HEADER.unpack_from(self.buf, self.start)[0]
+            if 0 < size <= MAX_MESSAGE:
+                need += size
+
+        # Not enough room left to finish the current frame, move it to the
+        # front of the buffer, or of a new one big enough to hold it.
+
+        if self.start + need > len(self.buf):
+            pending = bytes(self.view[self.start:self.end])
+            if need > len(self.buf):
+                self.reset(need)
+            self.buf[:len(pending)] = pending
+            self.start = 0
+            self.end = len(pending)
+
+        return self.view[self.end:]
+
+    def received(self, n):
+        self.end += n
+
 class CantoSocket:
     def __init__(self, socket_name, **kwargs):
 
@@ -51,6 +135,9 @@ class CantoSocket:
         self.read_locks = {}
         self.write_locks = {}
         self.write_frags = {}
+        self.read_bufs = {}
+        self.read_polls = {}
+        self.write_polls = {}
 
         self.connect()
 
@@ -182,6 +269,7 @@ class CantoSocket:
         self.read_locks[sock] = Lock()
         self.write_locks[sock] = Lock()
         self.write_frags[sock] = None
+        self.read_bufs[sock] = CantoReadBuffer()
         return sock
 
     # Setup poll.poll() object to watch for read status on conn.
@@ -225,52 +313,55 @@ class CantoSocket:
             return r
 
     def _do_read(self, conn, timeout):
-        poll = select.poll()
+        buf = self.read_bufs[conn]
 
-        try:
-            self.read_mode(poll, conn)
-        except:
-            log.error("Error putting conn in read mode.")
-            log.error("Interpreting as HUP")
-            return select.POLLHUP
+        # Every frame might've already been received by an earlier recv.
 
-        # We only care about the first (only) descriptor's event
-        try:
-            p = poll.poll(timeout)
-        except select.error as e:
-            if e.args[0] == errno.EINTR:
-                return
-            log.debug("Raising error: %s", e[1])
-            raise
+        while True:
+            message = buf.message()
+            if message != None:
+                # Never get POLLRDHUP on INET sockets, so
+                # use POLLIN with no data as POLLHUP
 
-        if timeout and not p:
-            return
+                if not message:
+                    log.debug("Read POLLIN with no data")
+                    return select.POLLHUP
 
-        e = p[0][1]
+                return self.parse(conn, message)
 
-        log.debug("E: %d", e)
-        if e & select.POLLERR:
-            log.debug("Read ERR")
-            return select.POLLHUP
-        if e & (select.POLLIN | select.POLLPRI):
-            message = b""
+            poll = self.read_polls.get(conn)
+            if not poll:
+                poll = select.poll()
+                try:
+                    self.read_mode(poll, conn)
+                except:
+                    log.error("Error putting conn in read mode.")
+                    log.error("Interpreting as HUP")
+                    return select.POLLHUP
+                self.read_polls[conn] = poll
 
+            # We only care about the first (only) descriptor's event
             try:
-                size_bytes = conn.recv(8)
-                if not size_bytes:
-                    log.debug("No bytes - HUP")
-                    return select.POLLHUP
-            except:
-                log.debug("Couldn't get size, interpreting as HUP\n")
-                return select.POLLHUP
+                p = poll.poll(timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    return
+                log.debug("Raising error: %s", e)
+                raise
 
-            size = struct.unpack('!q', size_bytes)[0]
+            # Timed out, any partial message stays buffered for next time.
+            if not p:
+                return
+
+            e = p[0][1]
 
-            while size:
+            log.debug("E: %d", e)
+            if e & select.POLLERR:
+                log.debug("Read ERR")
+                return select.POLLHUP
+            if e & (select.POLLIN | select.POLLPRI):
                 try:
-                    frag = conn.recv(min((4096, size)))
-                    size -= len(frag)
-                    message += frag
+                    n = conn.recv_into(buf.space())
                 except Exception as e:
                     if e.args[0] == errno.EINTR:
                         continue
@@ -279,25 +370,23 @@ class CantoSocket:
                     log.error("Interpreting as HUP")
                     return select.POLLHUP
 
-            # Never get POLLRDHUP on INET sockets, so
-            # use POLLIN with no data as POLLHUP
+                if not n:
+                    log.debug("No bytes - HUP")
+                    return select.POLLHUP
 
-            if not message:
-                log.debug("Read POLLIN with no data")
-                return select.POLLHUP
+                buf.received(n)
+                continue
 
-            return self.parse(conn, message.decode())
+            # Parse POLLHUP last so if we still got POLLIN, any data
+            # is still retrieved from the socket.
+            if e & select.POLLHUP:
+                log.debug("Read HUP")
+                return select.POLLHUP
 
-        # Parse POLLHUP last so if we still got POLLIN, any data
-        # is still retrieved from the socket.
-        if e & select.POLLHUP:
-            log.debug("Read HUP")
+            # Non-empty, but not anything we're interested in?
+            log.debug("Unknown poll.poll() return")
             return select.POLLHUP
 
-        # Non-empty, but not anything we're interested in?
-        log.debug("Unknown poll.poll() return")
-        return select.POLLHUP
-
     # Writes a (cmd, args) to a single connection, returns:
     # 1) None if the write completed.
     # 2) select.POLLHUP is the connection is dead.
@@ -325,6 +414,12 @@ class CantoSocket:
         else:
             wlock.acquire()
 
+        # Might've been cleaned up while we were waiting on the lock.
+
+        if conn not in self.write_frags:
+            wlock.release()
+            return
+
         r, frag = self._do_write(conn, cmd, args, self.write_frags[conn])
         wlock.release()
 
@@ -344,33 +439,37 @@ class CantoSocket:
 
         if cmd:
             message = json.dumps((cmd, args)).encode("UTF-8")
-            size = struct.pack("!q", len(message))
+            size = FRAME_HEADER.pack(len(message))
             tosend = size + message
 
         if frag:
             tosend = frag + tosend
 
-        while tosend:
+        poll = self.write_polls.get(conn)
+        if not poll:
             poll = select.poll()
-
             try:
                 self.write_mode(poll, conn)
             except:
                 log.error("Error putting conn in write mode.")
                 log.error("Interpreting as HUP")
                 return (select.POLLHUP, 0)
+            self.write_polls[conn] = poll
+
+        tosend = memoryview(tosend)
 
+        while tosend:
             try:
                 p = poll.poll(1)
             except select.error as e:
                 if e.args[0] == errno.EINTR:
-                    return (errno.EINTR, tosend)
+                    return (errno.EINTR, bytes(tosend))
                 log.error("Raising error: %s" % e[1])
                 raise
 
             if p == []:
                 log.debug("poll timed out")
-                return (errno.EINTR, tosend)
+                return (errno.EINTR, bytes(tosend))
 
             e = p[0][1]
 
@@ -388,7 +487,7 @@ class CantoSocket:
                     sent = conn.send(tosend)
                 except Exception as e:
                     if e.args[0] == errno.EINTR:
-                        return (errno.EINTR, tosend)
+                        return (errno.EINTR, bytes(tosend))
                     log.error("Error sending: %s" % e[1])
                     log.error("Interpreting as HUP")
                     return (select.POLLHUP, 0)
@@ -402,3 +501,6 @@ class CantoSocket:
         del self.read_locks[conn]
         del self.write_locks[conn]
         del self.write_frags[conn]
+        self.read_bufs.pop(conn, None)
+        self.read_polls.pop(conn, None)
+        self.write_polls.pop(conn, None)
@@ -480,29 +480,13 @@ class CantoRemote(PluginHandler, CantoClient):
 
         self.write("FORCEUPDATE", {})
 
-    def _numstate(self, tag, state):
-        self.write("AUTOATTR", [ "canto-state" ])
-        self.write("ITEMS", [ tag ])
-
-        items = []
-
-        cmd, r = self._wait_response(None)
-        while cmd != "ITEMSDONE":
-            if cmd == "ITEMS":
-                items.extend(r[tag])
-            cmd, r = self._wait_response(None)
-
-        if len(items) == 0:
-            return 0
-
-        attrs = self._wait_response("ATTRIBUTES")
-
+    def _numstate(self, counts, state):
         if state == "unread":
-            return len([ x for x in items if "read" not in attrs[x]["canto-state"]])
+            return counts["total"] - counts.get("read", 0)
         elif state == "read":
-            return len([ x for x in items if "read" in attrs[x]["canto-state"]])
+            return counts.get("read", 0)
         else:
-            return len(items)
+            return counts["total"]
 
     def cmd_status(self):
         """USAGE: canto-remote status (--tag=tag) (--read|--total|--tags)
@@ -531,9 +515,12 @@ class CantoRemote(PluginHandler, CantoClient):
         self.write("LISTTAGS","")
         t = self._wait_response("LISTTAGS")
 
+        self.write("TAGCOUNTS", t)
+        counts = self._wait_response("TAGCOUNTS")
+
         if "--tags" in sys.argv:
             for tag in t:
-                print("%s : %s" % (tag, self._numstate(tag, state)))
+                print("%s : %s" % (tag, self._numstate(counts[tag], state)))
         elif "--tag" in sys.argv:
             if "--tag" == sys.argv[-1]:
                 print("--tag must be followed by a tag name")
@@ -544,9 +531,9 @@ class CantoRemote(PluginHandler, CantoClient):
                 print("Unknown tag %s - use --tags to list known tags" % tag)
                 sys.exit(-1)
 
-            print("%s : %s" % (tag, self._numstate(tag, state)))
+            print("%s : %s" % (tag, self._numstate(counts[tag], state)))
         else:
-            print("%s" % sum([self._numstate(tag, state) for tag in t if tag.startswith("maintag:")]))
+            print("%s" % sum([self._numstate(counts[tag], state) for tag in t if tag.startswith("maintag:")]))
 
     def cmd_help(self):
         """USAGE: canto-remote help [command]"""
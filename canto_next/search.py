@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+from .rwlock import read_lock, write_lock
+from .locks import search_lock
+from .ids import allids
+
+import tempfile
+import logging
+import json
+import gzip
+import os
+import re
+
+log = logging.getLogger("SEARCH")
+
+# Attributes that get indexed.
+
+SEARCH_ATTRIBUTES = [ "title", "summary" ]
+
+html_tag = re.compile("<[^>]*>")
+word = re.compile("\\w+")
+
+# Split text into lowercase words, ignoring any HTML tags.
+
+def tokenize(text):
+    return word.findall(html_tag.sub(" ", text).lower())
+
+def item_words(item):
+    words = set()
+    for attr in SEARCH_ATTRIBUTES:
+        if attr in item and type(item[attr]) == str:
+            words.update(tokenize(item[attr]))
+    return words
+
+# An inverted index from words in the items' titles and summaries to the items
+# that contain them, so searching (and the Search transform) doesn't have to
+# read or match against every item's content.
+
+# The index is kept up to date by CantoFeed as items are indexed or have their
+# attributes set.
+
+class CantoSearch():
+    def __init__(self):
+        # { word : { id : None } }
+        self.words = {}
+
+        # { id : set(words) }
+        self.items = {}
+
+    def _remove(self, id):
+        for w in self.items.pop(id):
+            ids = self.words[w]
+            del ids[id]
+            if not ids:
+                del self.words[w]
+
+    def _add(self, id, words):
+        self.items[id] = words
+        for w in words:
+            if w in self.words:
+                self.words[w][id] = None
+            else:
+                self.words[w] = { id : None }
+
+    # Index items, { id : item }. Items already indexed are re-indexed.
+
+    @write_lock(search_lock)
+    def add_items(self, items):
+        for id in items:
+            words = item_words(items[id])
+
+            if id in self.items:
+                if self.items[id] == words:
+                    continue
+                self._remove(id)
+
+            self._add(id, words)
+
+    @write_lock(search_lock)
+    def remove_items(self, ids):
+        for id in ids:
+            if id in self.items:
+                self._remove(id)
+
+    @read_lock(search_lock)
+    def has_item(self, id):
+        return id in self.items
+
+    @write_lock(search_lock)
+    def clear(self):
+        self.words = {}
+        self.items = {}
+
+    # Whether item contains all of words (from tokenize()).
+
+    def matches(self, id, words):
+        item = self.items.get(id)
+        if item == None:
+            return False
+
+        for w in words:
+            if w not in item:
+                return False
+        return True
+
+    # Return ids of the items that contain all of the words in terms.
+
+    @read_lock(search_lock)
+    def search(self, terms):
+        words = tokenize(terms)
+        if not words:
+            return []
+
+        lists = []
+        for w in words:
+            if w not in self.words:
+                return []
+            lists.append(self.words[w])
+
+        lists.sort(key=len)
+
+        return [ id for id in lists[0] if\
+                all(id in ids for ids in lists[1:]) ]
+
+    # Save / load the same way as CantoTags, with a stamp to tell whether the
+    # index is still good.
+
+    @read_lock(search_lock)
+    def save(self, path, stamp):
+        f, tmpname = tempfile.mkstemp("", "search", os.path.dirname(path))
+        os.close(f)
+
+        items = []
+        for id in self.items:
+            URL, ID = allids.key(id)
+            items.append([ URL, ID, sorted(self.items[id]) ])
+
+        fp = gzip.open(tmpname, "wt", 6, "UTF-8")
+        json.dump({ "stamp" : stamp, "items" : items }, fp)
+        fp.close()
+
+        os.rename(tmpname, path)
+        log.debug("Saved search index of %d items", len(self.items))
+
+    @write_lock(search_lock)
+    def load(self, path, stamp):
+        if not os.path.exists(path):
+            return False
+
+        try:
+            fp = gzip.open(path, "rt", 6, "UTF-8")
+            try:
+                saved = json.load(fp)
+            finally:
+                fp.close()
+        except Exception as e:
+            log.error("Failed to load search index from %s: %s", path, e)
+            return False
+
+        if saved["stamp"] != stamp:
+            log.debug("Saved search index is stale")
+            return False
+
+        self.words = {}
+        self.items = {}
+
+        for URL, ID, words in saved["items"]:
+            self._add(allids.intern(URL, ID), set(words))
+
+        log.debug("Loaded search index of %d items", len(self.items))
+        return True
+
+allsearch = CantoSearch()
@@ -4,138 +4,405 @@
 #   Copyright (C) 2016 Jack Miller <jack@codezen.org>
 #
 #   This program is free software; you can redistribute it and/or modify
-#   it under the terms of the GNU General Public License version 2 as 
+#   it under the terms of the GNU General Public License version 2 as
 #   published by the Free Software Foundation.
 
-from .protocol import CantoSocket
+from .protocol import CantoSocket, CantoReadBuffer, FRAME_HEADER
 from .hooks import call_hook
 
+from concurrent.futures import Executor, Future
 from socket import SHUT_RDWR
 from threading import Thread, Lock
+from collections import deque
+from itertools import islice
+from queue import Queue
 import traceback
+import asyncio
 import logging
 import select
+import json
+import os
 
 log = logging.getLogger("SERVER")
 
+# Number of threads running commands. Commands from a single connection are
+# run one at a time, in the order they arrived, so this is also how many
+# connections can have a command running at once.
+
+WORKERS = 8
+
+# A minimal Executor for the event loop to hand commands off to. Unlike
+# ThreadPoolExecutor the threads are daemonic so, like the per-connection
+# threads they replaced, a command stuck on a lock can't hold up exiting.
+
+class CantoWorkers(Executor):
+    def __init__(self, workers):
+        self.jobs = Queue()
+        self.threads = []
+
+        for i in range(workers):
+            t = Thread(target = self.run, name = "Worker #%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if not job:
+                return
+
+            fut, fn, args, kwargs = job
+            if not fut.set_running_or_notify_cancel():
+                continue
+
+            try:
+                fut.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                fut.set_exception(e)
+
+    def submit(self, fn, *args, **kwargs):
+        fut = Future()
+        self.jobs.put((fut, fn, args, kwargs))
+        return fut
+
+    def shutdown(self, wait = True, **kwargs):
+        for t in self.threads:
+            self.jobs.put(None)
+
+        if wait:
+            for t in self.threads:
+                t.join()
+
+# Most bytes that can be queued for a connection before we give up on it.
+
+MAX_QUEUED = 64 * 1024 * 1024
+
+# Most buffers to hand a single sendmsg().
+
+try:
+    SEND_BUFFERS = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    SEND_BUFFERS = -1
+
+if SEND_BUFFERS <= 0:
+    SEND_BUFFERS = 16
+
+# Frames waiting to be sent to a single connection. Frames are queued by any
+# thread, under lock, and only sent by the event loop.
+
+class CantoWriteQueue():
+    def __init__(self):
+        self.lock = Lock()
+        self.frames = deque()
+        self.size = 0
+
+        # Whether a flush is scheduled, or waiting on the conn to be writable.
+        self.flushing = False
+
+        # Whether the flush is registered with the loop as a writer. Only
+        # touched by the event loop.
+        self.waiting = False
+
+        self.dead = False
+
+    def put(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+
+    # Drop the first n bytes, which have been sent.
+
+    def sent(self, n):
+        self.size -= n
+        while n:
+            frame = self.frames[0]
+            if len(frame) <= n:
+                n -= len(frame)
+                self.frames.popleft()
+            else:
+                self.frames[0] = memoryview(frame)[n:]
+                n = 0
+
+    def kill(self):
+        self.dead = True
+        self.frames.clear()
+        self.size = 0
+
+# All of the sockets are handled by a single asyncio event loop, running in
+# its own thread, that accepts connections, reads messages off of them and
+# sends whatever's been queued for them. Complete messages are parsed and
+# dispatched by the workers.
+
 class CantoServer(CantoSocket):
     def __init__(self, socket_name, dispatch, **kwargs):
         kwargs["server"] = True
         CantoSocket.__init__(self, socket_name, **kwargs)
         self.dispatch = dispatch
-        self.conn_thread = None
 
         self.connections_lock = Lock()
-        self.connections = [] # (socket, thread) tuples
+        self.connections = []
+        self.write_queues = {}
         self.alive = True
 
-        self.start_conn_loop()
+        self.workers = CantoWorkers(WORKERS)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = None
+
+        self.start_loop()
+
+    def start_loop(self):
+        for s in self.sockets:
+            self.loop.add_reader(s, self.accept, s)
+
+        self.loop_thread = Thread(target = self.loop.run_forever,
+                name = "Server")
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        log.debug("Spawned server thread.")
+
+    # Listening socket is readable, so it's got a pending connection.
+
+    def accept(self, sock):
+        try:
+            conn = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            log.error("Failed to accept connection: %s" % e)
+            return
+
+        log.info("conn %s from sock %s" % (conn, sock))
+        conn[0].setblocking(False)
+        self.loop.create_task(self.serve(conn[0]))
+
+    # Return the next message from conn, or select.POLLHUP
+
+    async def read_message(self, conn, buf):
+        while True:
+            message = buf.message()
+            if message != None:
+                if not message:
+                    log.debug("Read no message - HUP")
+                    return select.POLLHUP
+                return message
+
+            try:
+                n = await self.loop.sock_recv_into(conn, buf.space())
+            except OSError as e:
+                log.debug("Error receiving: %s" % e)
+                return select.POLLHUP
+
+            if not n:
+                log.debug("No bytes - HUP")
+                return select.POLLHUP
+
+            buf.received(n)
+
+    # Endlessly consume messages from the connection, handing each one to a
+    # worker and waiting for it to be handled before reading the next.
 
-    # Endlessly consume data from the connection. If there's enough data
-    # for a complete command, toss it on the shared Queue.Queue
+    async def serve(self, conn):
+        await self.loop.run_in_executor(self.workers, self.accept_conn, conn)
+
+        buf = CantoReadBuffer()
 
-    def read_loop(self, conn):
         try:
             while self.alive:
-                d = self.do_read(conn)
-                if d:
-                    if d == select.POLLHUP:
-                        log.info("Connection ended.")
-                        return
-                    self.dispatch(conn, d)
+                message = await self.read_message(conn, buf)
+                if message == select.POLLHUP:
+                    log.info("Connection ended.")
+                    break
+
+                await self.loop.run_in_executor(self.workers, self.command,
+                        conn, message)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             tb = traceback.format_exc()
-            log.error("Response thread dead on exception:")
+            log.error("Connection dead on exception:")
             log.error("\n" + "".join(tb))
-            return
 
-    # Sit and select for connections on sockets:
+        if self.alive:
+            await self.loop.run_in_executor(self.workers, self.kill_conn, conn)
+            self.loop.remove_writer(conn)
+            conn.close()
 
-    def conn_loop(self, sockets):
-        while self.alive:
-            try:
-                # select with a timeout so we can check we're still alive
-                r, w, x = select.select(sockets, [], sockets, 1)
-                for s in sockets:
-                    # If socket is readable, it's got a pending connection.
-                    if s in r:
-                        conn = s.accept()
-                        log.info("conn %s from sock %s" % (conn, s))
-                        self.accept_conn(conn[0])
-            except Exception as e:
-                tb = traceback.format_exc()
-                log.error("Connection monitor exception:")
-                log.error("\n" + "".join(tb))
-                log.error("Attempting to continue.")
-
-    def start_conn_loop(self):
-        self.conn_thread = Thread(target = self.conn_loop,
-                args = (self.sockets,), name = "Connection Monitor")
-        self.conn_thread.daemon = True
-        self.conn_thread.start()
-        log.debug("Spawned connection monitor thread.")
-
-    # Remove dead connection threads.
-
-    def no_dead_conns(self):
-        self.connections_lock.acquire()
-        for c, t in self.connections[:]:
-            if not t.is_alive():
-                call_hook("server_kill_socket", [c])
-                t.join()
-                c.close()
-                self.connections.remove((c, t))
-                if self.connections == []:
-                    call_hook("server_no_connections", [])
-        self.connections_lock.release()
+    def command(self, conn, message):
+        d = self.parse(conn, message)
+        if d:
+            self.dispatch(conn, d)
 
     def accept_conn(self, conn):
-        self.read_locks[conn] = Lock()
-        self.write_locks[conn] = Lock()
-        self.write_frags[conn] = None
+        self.write_queues[conn] = CantoWriteQueue()
 
         # Notify watchers about new socket.
         call_hook("server_new_socket", [conn])
 
         self.connections_lock.acquire()
 
-        self.connections.append((conn,\
-                Thread(target = self.read_loop,\
-                       args = (conn,), name="Connection #%s" %\
-                       (len(self.connections)))
-                ))
-
-        self.connections[-1][1].daemon = True
-        self.connections[-1][1].start()
+        self.connections.append(conn)
 
         if len(self.connections) == 1:
             call_hook("server_first_connection", [])
 
         self.connections_lock.release()
 
-        log.debug("Spawned new thread.")
+    def kill_conn(self, conn):
+        call_hook("server_kill_socket", [conn])
+
+        self.connections_lock.acquire()
+
+        self.connections.remove(conn)
+
+        q = self.write_queues.pop(conn)
+        q.lock.acquire()
+        q.kill()
+        q.lock.release()
+
+        if self.connections == []:
+            call_hook("server_no_connections", [])
+
+        self.connections_lock.release()
+
+    # A write found the connection dead. Wake up the read side, which cleans
+    # it up.
+
+    def disconnected(self, conn):
+        try:
+            conn.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    # Send as much of conn's queue as it will take, in one sendmsg(), and
+    # keep at it whenever conn is writable until the queue is empty.
+
+    def flush(self, conn):
+        q = self.write_queues.get(conn)
+        if not q:
+            return
+
+        q.lock.acquire()
+        if q.dead:
+            q.lock.release()
+            if q.waiting:
+                self.loop.remove_writer(conn)
+                q.waiting = False
+            return
+        bufs = list(islice(q.frames, SEND_BUFFERS))
+        q.lock.release()
+
+        try:
+            sent = conn.sendmsg(bufs)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            log.debug("Error sending: %s" % e)
+            log.debug("Interpreting as HUP")
+            q.lock.acquire()
+            q.kill()
+            q.lock.release()
+            self.loop.remove_writer(conn)
+            self.disconnected(conn)
+            return
+
+        log.debug("Sent %d bytes.", sent)
+
+        q.lock.acquire()
+        if not q.dead:
+            q.sent(sent)
+        if q.dead or not q.frames:
+            q.flushing = False
+            waiting = False
+        else:
+            waiting = True
+        q.lock.release()
+
+        if waiting != q.waiting:
+            if waiting:
+                self.loop.add_writer(conn, self.flush, conn)
+            else:
+                self.loop.remove_writer(conn)
+            q.waiting = waiting
+
+    # Queue a (cmd, args) to a single connection. This never waits on the
+    # connection itself, the event loop sends it when it can. Returns
+    # select.POLLHUP if the connection is dead.
 
-    # Write a (cmd, args) to a single connection.
     def write(self, conn, cmd, args):
         if not conn:
             return None
-        return self.do_write(conn, cmd, args)
+
+        q = self.write_queues.get(conn)
+        if not q:
+            return select.POLLHUP
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("\n\nWrite:\n%s\n", json.dumps((cmd, args), indent=4, sort_keys=True))
+
+        message = json.dumps((cmd, args)).encode("UTF-8")
+
+        q.lock.acquire()
+
+        if q.dead:
+            q.lock.release()
+            return select.POLLHUP
+
+        q.put(FRAME_HEADER.pack(len(message)))
+        q.put(message)
+
+        # Client isn't keeping up, give up on it rather than queueing
+        # without bound.
+
+        if q.size > MAX_QUEUED:
+            log.error("Dropping connection with %d bytes unsent" % q.size)
+            q.kill()
+            q.lock.release()
+            self.disconnected(conn)
+            return select.POLLHUP
+
+        if not q.flushing:
+            q.flushing = True
+            try:
+                self.loop.call_soon_threadsafe(self.flush, conn)
+            except RuntimeError:
+                # Loop is closed, we're exiting.
+                pass
+
+        q.lock.release()
 
     # Write a (cmd, args) to every connection.
     def write_all(self, cmd, args):
-        self.no_dead_conns()
-
         self.connections_lock.acquire()
-        for conn, t in self.connections:
-            self.do_write(conn, cmd, args)
+        conns = self.connections[:]
         self.connections_lock.release()
 
+        for conn in conns:
+            self.write(conn, cmd, args)
+
+    def stop_loop(self):
+        for s in self.sockets:
+            self.loop.remove_reader(s)
+
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+
+        # Let the tasks see they've been cancelled before stopping.
+        self.loop.call_soon(self.loop.stop)
+
     def exit(self):
         self.alive = False
-        self.conn_thread.join()
+        self.loop.call_soon_threadsafe(self.stop_loop)
+        self.loop_thread.join()
+        self.loop.close()
+
+        # Don't wait for the workers, they may be waiting on locks we hold.
+        self.workers.shutdown(False)
 
         # No locking, as we should already be single-threaded
 
-        for conn, t in self.connections:
-            conn.shutdown(SHUT_RDWR)
+        for conn in self.connections:
+            try:
+                conn.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
             conn.close()
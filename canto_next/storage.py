@@ -10,7 +10,12 @@
 from .feed import wlock_feeds
 from .hooks import call_hook
 
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from threading import Thread, Lock, Event, Condition
 import tempfile
+import hashlib
 import logging
 import shutil
 import json
@@ -18,14 +23,169 @@ import gzip
 import time
 import os
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
 log = logging.getLogger("SHELF")
 
+# Journals are compacted back into the main file when they grow past
+# JOURNAL_COMPACT_RATIO times the size of the last snapshot, but not before
+# they're JOURNAL_MIN_COMPACT bytes.
+
+JOURNAL_MIN_COMPACT = 4 * 1024 * 1024
+JOURNAL_COMPACT_RATIO = 4
+
+# The sync scheduler waits for changes to settle for SYNC_DEBOUNCE seconds, but
+# never leaves them unsynced longer than SYNC_MAX_LATENCY seconds, and never
+# syncs more often than every SYNC_MIN_INTERVAL seconds.
+
+SYNC_DEBOUNCE = 5
+SYNC_MAX_LATENCY = 60
+SYNC_MIN_INTERVAL = 10
+SYNC_TICK = 1
+
+# Item attributes that change often (read state, user tags) and are small.
+# Changes that only touch these are appended to a small state journal instead
+# of rewriting the feed content they belong to.
+
+HOT_ATTRIBUTES = [ "canto-state", "canto-tags" ]
+
+# The state journal is folded back into the main storage once it's this big.
+
+STATE_MIN_COMPACT = 1024 * 1024
+
+# The feeds file is decoded this many characters at a time.
+
+LOAD_CHUNK = 64 * 1024
+
+# Decode the top level { key : value } object of a JSON file one value at a
+# time, so the whole file never has to be in memory as text.
+
+class CantoJSONStream():
+    def __init__(self, fp):
+        self.fp = fp
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        data = self.fp.read(size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill(LOAD_CHUNK):
+                return
+
+    def expect(self, chars):
+        self.skip_whitespace()
+        if self.pos >= len(self.buf) or self.buf[self.pos] not in chars:
+            raise ValueError("Expected one of %s at %d" % (chars, self.pos))
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    # If the value doesn't decode, it may just be incomplete, so read more,
+    # doubling each time so big values don't get decoded too many times.
+
+    def value(self):
+        self.skip_whitespace()
+        size = LOAD_CHUNK
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+
+                # A number at the end of the buffer may be cut off.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+
+            self.fill(size)
+            size *= 2
+
+    def items(self):
+        self.expect("{")
+        self.skip_whitespace()
+        if self.buf[self.pos:self.pos + 1] == "}":
+            return
+
+        while True:
+            key = self.value()
+            if type(key) != str:
+                raise ValueError("Bad key: %s" % key)
+            self.expect(":")
+            yield (key, self.value())
+
+            if self.expect(",}") == "}":
+                return
+
 class CantoShelf():
     def __init__(self, filename):
         self.filename = filename
 
         self.cache = {}
 
+        # { URL : { id : entry } } for feeds that have been looked up, built as
+        # needed and dropped whenever the feed's entries are replaced.
+        self.indexes = {}
+
+        # Keys touched since the last sync.
+        self.dirty = set()
+
+        # Keys whose values are referenced by the snapshot being written. These
+        # must be copied before they're changed in place.
+        self.shared = set()
+        self.writer = None
+
+        # Held while preparing a sync and starting its writer, and while
+        # waiting on the writer, so there's only ever one writer and syncs
+        # land in the order they were taken.
+        self.sync_lock = Lock()
+
+        # What a failed writer didn't manage to write, (keys, state records),
+        # to be tried again by the next sync.
+        self.failed = None
+
+        # When the first unsynced change was made, and the latest.
+        self.dirty_since = 0
+        self.last_change = 0
+
+        # How long the last sync held the feed locks.
+        self.lock_time = 0
+
+        # Hot attribute changes since the last sync, as (URL, id, attrs).
+        self.state_records = []
+        self.state_name = filename + ".state"
+
+        # Every sync gets a new generation, which is stamped on everything it
+        # writes, so journaled records are only replayed over older content.
+        self.generation = 0
+        self.loaded_generation = 0
+
+        # Whether the feeds file is missing changes, for shelves that don't
+        # keep their content in it (see export_value()).
+        self.export_needed = False
+        self.export_name = filename + ".exported"
+
+        # Set while the feeds file is still being loaded in the background.
+        self.loading = False
+        self.load_cond = Condition()
+        self.loader = None
+
         self.open()
 
     def check_control_data(self):
@@ -36,98 +196,1389 @@ class CantoShelf():
             if ctrl_field not in self.cache["control"]:
                 self.cache["control"][ctrl_field] = 0
 
+    # The feeds file is loaded by a separate thread, one key at a time. Each
+    # key can be used as soon as it's loaded, anything that needs a key that
+    # isn't there yet waits for it, or for loading to finish.
+
     @wlock_feeds
     def open(self):
         call_hook("daemon_db_open", [self.filename])
 
+        self.cache = {}
+        self.indexes = {}
+
         if not os.path.exists(self.filename):
             fp = gzip.open(self.filename, "wt", 9, "UTF-8")
-            json.dump(self.cache, fp)
+            json.dump({}, fp)
             fp.close()
+            self.check_control_data()
+            return
+
+        # Pending state is small, read it first so it can be applied to each
+        # feed as it's loaded.
+
+        records = {}
+        if os.path.exists(self.state_name):
+            for record in self.read_records(self.state_name):
+                records.setdefault(record[2], []).append(record)
+
+        self.loading = True
+        self.loader = Thread(target = self.load, args = (records,),
+                name = "Shelf loader")
+        self.loader.daemon = True
+        self.loader.start()
+
+    def load(self, records):
+        start = time.time()
+        loaded = 0
+
+        # Values that can't be finished until control data (and so the
+        # generation of the file) is loaded.
+        held = []
+
+        fp = gzip.open(self.filename, "rt", 9, "UTF-8")
+        try:
+            for key, value in CantoJSONStream(fp).items():
+                loaded += 1
+                if key == "control":
+                    self.load_control(value, records.pop(key, []))
+                    for key, value in held:
+                        self.load_key(key, value, records.pop(key, []))
+                    held = None
+                elif held != None and key in records:
+                    held.append((key, value))
+                else:
+                    self.load_key(key, value, records.pop(key, []))
+        except Exception as e:
+            if loaded:
+                log.error("Failed to load %s after %d keys: %s", self.filename, loaded, e)
+                log.error("Carrying on with what was loaded")
+            else:
+                log.info("Failed to JSON load, old shelf?")
+                self.load_shelve()
+        finally:
+            fp.close()
+
+        for key, value in held or []:
+            self.load_key(key, value, records.pop(key, []))
+
+        # Anything left is for keys that weren't in the file.
+        for key in records:
+            self.load_key(key, None, records[key])
+
+        # Only now do we know there was no control data.
+
+        with self.load_cond:
+            self.check_control_data()
+            self.loading = False
+            self.load_cond.notify_all()
+
+        log.debug("Loaded %d keys in %.3fs", loaded, time.time() - start)
+
+    def load_shelve(self):
+        try:
+            import shelve
+            s = shelve.open(self.filename, "r")
+            for key in s:
+                self.load_key(key, s[key], [])
+        except Exception as e:
+            log.error("Failed to migrate old shelf: %s", e)
+            try:
+                f = open(self.filename)
+                data = f.read()
+                f.close()
+                log.error("BAD DATA: [%s]" % data)
+            except Exception as e:
+                log.error("Couldn't even read data? %s" % e)
+                pass
+            log.error("Carrying on with empty shelf")
         else:
-            fp = gzip.open(self.filename, "rt", 9, "UTF-8")
+            log.info("Migrated old shelf")
+
+    def load_key(self, key, value, records):
+        loaded = {}
+        if value != None:
+            loaded[key] = value
+
+        self.apply_records(records, loaded)
+
+        with self.load_cond:
+            if key in loaded:
+                self.cache[key] = loaded[key]
+            self.load_cond.notify_all()
+
+    # Anything that needs control data (including changes, which update its
+    # timestamps) waits for it to be loaded.
+
+    def load_control(self, value, records):
+        self.loaded_generation = value.get("canto-generation", 0)
+        self.generation = max(self.generation, self.loaded_generation)
+
+        loaded = { "control" : value }
+        self.apply_records(records, loaded)
+        value = loaded["control"]
+
+        with self.load_cond:
+            self.cache["control"] = value
+            self.check_control_data()
+            self.load_cond.notify_all()
+
+    def wait_key(self, key):
+        if not self.loading:
+            return
+
+        with self.load_cond:
+            while self.loading and key not in self.cache:
+                self.load_cond.wait()
+
+    def wait_loaded(self):
+        if not self.loading:
+            return
+
+        with self.load_cond:
+            while self.loading:
+                self.load_cond.wait()
+
+    # Return the generation of key's content as loaded from disk.
+
+    def key_generation(self, key):
+        return self.loaded_generation
+
+    # Whether attr is kept in memory for every entry, i.e. it can be compared
+    # between the old entries and the new without going to disk.
+
+    def is_resident(self, attr):
+        return True
+
+    # Journal records are
+    #   [ "set", generation, key, value ]
+    #   [ "del", generation, key ]
+    #   [ "state", generation, URL, id, { attribute : value } ]
+
+    # A half-written trailing record (i.e. we died mid-sync) is discarded, and
+    # cut off the journal so records appended later aren't joined onto it.
+
+    def read_records(self, journal):
+        records = []
+        good = 0
+
+        fp = open(journal, "rb")
+        for line in fp:
             try:
-                self.cache = json.load(fp)
+                if not line.endswith(b"\n"):
+                    raise ValueError("Unterminated record")
+                records.append(json.loads(line.decode("UTF-8")))
             except:
-                log.info("Failed to JSON load, old shelf?")
-                try:
-                    import shelve
-                    s = shelve.open(self.filename, "r")
-                    for key in s:
-                        self.cache[key] = s[key]
-                except Exception as e:
-                    log.error("Failed to migrate old shelf: %s", e)
-                    try:
-                        f = open(self.filename)
-                        data = f.read()
-                        f.close()
-                        log.error("BAD DATA: [%s]" % data)
-                    except Exception as e:
-                        log.error("Couldn't even read data? %s" % e)
-                        pass
-                    log.error("Carrying on with empty shelf")
-                    self.cache = {}
-                else:
-                    log.info("Migrated old shelf")
-            finally:
-                fp.close()
+                log.info("Discarding partial journal record in %s", journal)
+                break
+            good += len(line)
+        fp.close()
 
-        self.check_control_data()
+        if good < os.path.getsize(journal):
+            fp = open(journal, "r+b")
+            fp.truncate(good)
+            fp.flush()
+            os.fsync(fp.fileno())
+            fp.close()
+
+        return records
+
+    # Apply records to cache, skipping any where the content on disk is
+    # already at least as new.
+
+    def apply_records(self, records, cache):
+        applied = 0
+        entries = {}
+
+        for record in records:
+            op, gen, key = record[:3]
+            self.generation = max(self.generation, gen)
+
+            if gen <= self.key_generation(key):
+                continue
+
+            if op == "state":
+                if key not in cache:
+                    continue
+                if key not in entries:
+                    entries[key] = dict([ (e["id"], e) for e in cache[key]["entries"] ])
+                if record[3] in entries[key]:
+                    entries[key][record[3]].update(record[4])
+            elif op == "set":
+                cache[key] = record[3]
+                entries.pop(key, None)
+            elif op == "del" and key in cache:
+                del cache[key]
+                entries.pop(key, None)
+            applied += 1
+
+        return applied
+
+    def replay(self, journal):
+        replayed = self.apply_records(self.read_records(journal), self.cache)
+        log.debug("Replayed %d records from %s", replayed, journal)
+
+    def append_records(self, journal, records):
+        fp = open(journal, "a", encoding="UTF-8")
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+
+        log.debug("Journaled %d records to %s", len(records), journal)
 
     def __setitem__(self, name, value):
+        self.wait_key(name)
         self.cache[name] = value
+        self.indexes.pop(name, None)
+        self.dirty.add(name)
         self.update_mod()
 
     def __getitem__(self, name):
+        self.wait_key(name)
         return self.cache[name]
 
     def __contains__(self, name):
+        self.wait_key(name)
         return name in self.cache
 
     def __delitem__(self, name):
+        self.wait_key(name)
         if name in self.cache:
             del self.cache[name]
+        self.indexes.pop(name, None)
+        self.dirty.add(name)
+        self.update_mod()
+
+    # Return { id : entry } for the entries of feed URL with the given item ids.
+    # Items that can't be found are left out. If attributes is given, the
+    # caller only needs those attributes of each entry.
+
+    def get_entries(self, URL, ids, attributes=None):
+        self.wait_key(URL)
+        if URL not in self.cache:
+            return {}
+
+        index = self.indexes.get(URL)
+        if index == None:
+            index = dict([ (e["id"], e) for e in self.cache[URL]["entries"] ])
+            self.indexes[URL] = index
+
+        r = {}
+        for id in ids:
+            if id in index:
+                r[id] = index[id]
+        return r
+
+    # Given { id : { attribute : value } }, update the matching entries of
+    # feed URL and return them.
+
+    # If only hot attributes are changed, the feed itself isn't dirtied, the
+    # change is just recorded to be journaled.
+
+    def set_entry_attributes(self, URL, attributes):
+        self.unshare(URL)
+
+        entries = CantoShelf.get_entries(self, URL, list(attributes.keys()))
+
+        hot = True
+        for id in entries:
+            entries[id].update(attributes[id])
+            for attr in attributes[id]:
+                if attr not in HOT_ATTRIBUTES:
+                    hot = False
+
+        if hot:
+            for id in entries:
+                self.state_records.append((URL, id, attributes[id]))
+        else:
+            self.dirty.add(URL)
         self.update_mod()
 
+        return list(entries.values())
+
     def update_umod(self):
-        if "control" not in self.cache:
-            self.cache["control"] = self.cache['control']
+        self.wait_key("control")
+        self.unshare("control")
 
         ts = int(time.mktime(time.gmtime()))
         self.cache["control"]["canto-user-modified"] = ts
         self.cache["control"]["canto-modified"] = ts
+        self.dirty.add("control")
+        self.export_needed = True
+
+        self.last_change = time.time()
+        if not self.dirty_since:
+            self.dirty_since = self.last_change
 
     def update_mod(self):
-        if "control" not in self.cache:
-            self.cache["control"] = self.cache['control']
+        self.wait_key("control")
+        self.unshare("control")
 
         ts = int(time.mktime(time.gmtime()))
         self.cache["control"]["canto-modified"] = ts
+        self.dirty.add("control")
+        self.export_needed = True
 
-    @wlock_feeds
-    def sync(self):
+        self.last_change = time.time()
+        if not self.dirty_since:
+            self.dirty_since = self.last_change
 
-        # If we get a sync after we're closed, or before we're open
-        # just ignore it.
+    # Syncing is done in two stages. First, with all of the feeds locked, we
+    # take a snapshot of the values to be written. That's just a dict of
+    # references, so it's cheap. The snapshot is then serialized and written
+    # by a writer thread without holding any locks.
 
-        if self.cache == {}:
+    # Values changed in place (attribute changes, control timestamps, old
+    # entries kept by index()) are unshared first, so the snapshot stays
+    # consistent.
+
+    def snapshot(self, keys=None):
+        if keys == None:
+            keys = list(self.cache.keys())
+
+        snap = {}
+        for key in keys:
+            if key in self.cache:
+                snap[key] = self.cache[key]
+                self.shared.add(key)
+            else:
+                snap[key] = None
+        return snap
+
+    def unshare(self, key):
+        if key not in self.shared or key not in self.cache:
             return
 
+        self.shared.discard(key)
+
+        value = self.cache[key]
+        if type(value) == dict:
+            value = value.copy()
+            if type(value.get("entries")) == list:
+                value["entries"] = [ self.copy_entry(e) for e in value["entries"] ]
+
+        self.cache[key] = value
+        self.indexes.pop(key, None)
+
+    # Return the value of key to be written to the feeds file for snap.
+
+    def export_value(self, key, snap):
+        return snap[key]
+
+    # Entries are copied along with their canto-* lists (i.e. state and tags),
+    # which get appended to in place.
+
+    def copy_entry(self, entry):
+        entry = entry.copy()
+        for key in entry:
+            if key.startswith("canto") and type(entry[key]) == list:
+                entry[key] = entry[key][:]
+        return entry
+
+    # Write a full, gzipped copy of a snapshot to disk. Each key is serialized
+    # separately, so we don't hog the GIL for the whole shelf at once.
+
+    def write_snapshot(self, snap):
         f, tmpname = tempfile.mkstemp("", "feeds", os.path.dirname(self.filename))
         os.close(f)
 
+        # Control data goes first, so the loader knows its generation before
+        # any feeds.
+
+        keys = sorted(snap.keys(), key = lambda k: (k != "control", k))
+
         fp = gzip.open(tmpname, "wt", 9, "UTF-8")
-        json.dump(self.cache, fp, indent=4, sort_keys=True)
+        fp.write("{")
+        for i, key in enumerate(keys):
+            if i > 0:
+                fp.write(",")
+            fp.write("\n" + json.dumps(key) + ": " +\
+                    json.dumps(self.export_value(key, snap), sort_keys=True))
+        fp.write("\n}\n")
         fp.close()
 
         log.debug("Written tempfile.")
 
         shutil.move(tmpname, self.filename)
 
-        log.debug("Synced.")
+    # Shelves that keep their content elsewhere still write the feeds file on
+    # a full sync, for plugins that use it directly (i.e. sync-rsync), and
+    # note what it looked like afterwards. If it's been replaced since, it's
+    # imported when the shelf is next opened.
+
+    def feeds_stat(self):
+        st = os.stat(self.filename)
+        return [ st.st_ino, st.st_mtime_ns, st.st_size ]
+
+    def mark_exported(self):
+        fp = open(self.export_name, "w")
+        json.dump(self.feeds_stat(), fp)
+        fp.close()
+
+    def feeds_replaced(self):
+        if not os.path.exists(self.export_name) or\
+                not os.path.exists(self.filename):
+            return False
+
+        try:
+            fp = open(self.export_name, "r")
+            exported = json.load(fp)
+            fp.close()
+        except Exception as e:
+            log.error("Failed to read %s: %s", self.export_name, e)
+            return False
+
+        return exported != self.feeds_stat()
+
+    # Start a new generation for the sync being prepared, and stamp it on the
+    # control data so it's written with any full snapshot.
+
+    def next_generation(self):
+        self.generation += 1
+        self.unshare("control")
+        self.cache["control"]["canto-generation"] = self.generation
+
+    # Turn the pending hot attribute changes into state records, except for
+    # those in feeds that are part of snap, which already include them.
+
+    def take_state_records(self, snap):
+        records = []
+        for URL, id, attrs in self.state_records:
+            if URL not in snap:
+                records.append([ "state", self.generation, URL, id, attrs ])
+        self.state_records = []
+        return records
+
+    # Called with feeds write locked, returns (function, snapshot, records) to
+    # be run by the writer, or None if there's nothing to do.
+
+    # If full is set, the feeds file must be left complete (i.e. for sync
+    # plugins that copy it), so nothing can be left in a journal.
+
+    def prepare_sync(self, full):
+
+        # If we get a sync after we're closed, or before we're open
+        # just ignore it.
+
+        if self.cache == {}:
+            return None
+
+        if not (self.dirty or self.state_records):
+            if not (full and os.path.exists(self.state_name)):
+                return None
+
+        self.next_generation()
+
+        # Only state and control changes, just journal them.
+
+        if not full and self.dirty <= set([ "control" ]) and\
+                self.state_size() < STATE_MIN_COMPACT:
+            snap = self.snapshot([ "control" ])
+            self.dirty = set()
+            records = self.take_state_records(snap)
+            records.append([ "set", self.generation, "control", snap["control"] ])
+            return (self.append_state, snap, records)
+
+        self.dirty = set()
+        self.state_records = []
+        return (self.write_full, self.snapshot(), [])
+
+    def state_size(self):
+        if os.path.exists(self.state_name):
+            return os.path.getsize(self.state_name)
+        return 0
+
+    def append_state(self, snap, records):
+        self.append_records(self.state_name, records)
+
+    def write_full(self, snap, records):
+        self.write_snapshot(snap)
+
+        # The snapshot is newer than anything in the state journal.
+
+        if os.path.exists(self.state_name):
+            os.unlink(self.state_name)
+
+    # The writer doesn't take the feed locks (whoever's waiting on it may
+    # hold them), so it leaves anything it failed to write for the next sync
+    # to pick up, rather than touching dirty and state_records itself.
+
+    def run_writer(self, fn, snap, records):
+        try:
+            fn(snap, records)
+            log.debug("Synced.")
+        except Exception as e:
+            log.error("Failed to sync: %s" % e)
+            self.failed = (list(snap.keys()), [ tuple(record[2:])\
+                    for record in records if record[0] == "state" ])
+
+        # The snapshot is no longer in use.
+        self.shared = set()
+
+    def _wait_writer(self):
+        if self.writer:
+            self.writer.join()
+            self.writer = None
+
+    def wait_writer(self):
+        self.sync_lock.acquire()
+        try:
+            self._wait_writer()
+        finally:
+            self.sync_lock.release()
+
+    @wlock_feeds
+    def _prepare_sync(self, full):
+        start = time.time()
+
+        # Try again whatever the last writer failed to write.
+        if self.failed:
+            keys, state_records = self.failed
+            self.failed = None
+            self.dirty.update(keys)
+            self.state_records = state_records + self.state_records
+
+        self.dirty_since = 0
+        job = self.prepare_sync(full)
+
+        self.lock_time = time.time() - start
+        log.debug("Sync held feed locks for %.3fs", self.lock_time)
+        return job
+
+    def sync(self, full=False):
+        self.sync_lock.acquire()
+        try:
+
+            # Nothing can be written until we have it all.
+
+            self.wait_loaded()
+
+            # Let the last write land first, so they happen in order.
+
+            self._wait_writer()
+
+            job = self._prepare_sync(full)
+            if job:
+                self.writer = Thread(target = self.run_writer, args = job,
+                        name = "Shelf writer")
+                self.writer.daemon = True
+                self.writer.start()
+        finally:
+            self.sync_lock.release()
 
     def close(self):
         log.debug("Closing.")
-        self.sync()
+        self.sync(True)
+        self.wait_writer()
         self.cache = {}
+        self.indexes = {}
         call_hook("daemon_db_close", [self.filename])
+
+# The journal shelf keeps the same gzipped snapshot as CantoShelf, but instead
+# of rewriting it on every sync, it appends the keys that changed to a plain
+# JSON journal (one record per line) next to it. Once the journal grows large
+# enough, the snapshot is rewritten in the background and the journal dropped.
+
+# On open, the snapshot is read and then the journal(s) replayed on top of it.
+# A half-written trailing record (i.e. we died mid-sync) is discarded.
+
+class CantoJournalShelf(CantoShelf):
+    def __init__(self, filename):
+        self.journal_name = filename + ".journal"
+
+        # During compaction, the journal is moved here until the new snapshot
+        # is in place.
+        self.old_journal_name = self.journal_name + ".old"
+
+        CantoShelf.__init__(self, filename)
+
+    @wlock_feeds
+    def open(self):
+        CantoShelf.open(self)
+        self.wait_loaded()
+
+        for journal in [ self.old_journal_name, self.journal_name ]:
+            if os.path.exists(journal):
+                self.replay(journal)
+
+        self.dirty = set()
+
+    def journal_size(self):
+        if os.path.exists(self.journal_name):
+            return os.path.getsize(self.journal_name)
+        return 0
+
+    def needs_compact(self):
+        snap_size = 0
+        if os.path.exists(self.filename):
+            snap_size = os.path.getsize(self.filename)
+
+        journal_size = self.journal_size()
+        if journal_size < JOURNAL_MIN_COMPACT:
+            return False
+        return journal_size > snap_size * JOURNAL_COMPACT_RATIO
+
+    def prepare_sync(self, full):
+        if self.cache == {}:
+            return None
+
+        if full or self.needs_compact():
+            return self.prepare_compact()
+
+        if not (self.dirty or self.state_records):
+            return None
+
+        self.next_generation()
+
+        snap = self.snapshot(self.dirty)
+        self.dirty = set()
+
+        records = []
+        for key in sorted(snap.keys()):
+            if snap[key] != None:
+                records.append([ "set", self.generation, key, snap[key] ])
+            else:
+                records.append([ "del", self.generation, key ])
+        records += self.take_state_records(snap)
+
+        return (self.append_journal, snap, records)
+
+    def append_journal(self, snap, records):
+        self.append_records(self.journal_name, records)
+
+    # Called with feeds write locked, and no writer running.
+
+    def prepare_compact(self):
+        if os.path.exists(self.old_journal_name):
+            log.info("Previous compaction failed, retrying.")
+        elif os.path.exists(self.journal_name):
+            os.rename(self.journal_name, self.old_journal_name)
+        elif not (self.dirty or self.state_records):
+            return None
+
+        # The snapshot covers everything in the old journal, as well as
+        # anything dirty that hasn't been journaled yet.
+
+        self.next_generation()
+        self.dirty = set()
+        self.state_records = []
+        return (self.compact, self.snapshot(), [])
+
+    def compact(self, snap, records):
+        self.write_snapshot(snap)
+
+        # Once the snapshot is in place, the old journal is redundant. If we die
+        # before it's removed, replaying it is harmless because the records
+        # match the snapshot.
+
+        if os.path.exists(self.old_journal_name):
+            os.unlink(self.old_journal_name)
+        log.debug("Compacted.")
+
+# The sharded shelf stores each key (i.e. each feed) in its own gzip file in a
+# directory next to the feeds file, so a sync only has to rewrite the shards for
+# keys that were actually touched.
+
+# If there's no shard directory yet, or the feeds file has been replaced since
+# it was last exported, the contents of the feeds file are imported as shards.
+# A full sync exports the shards back to the feeds file.
+
+# Hot attribute changes are journaled to the state file, which is folded back
+# into the shards once it grows past STATE_MIN_COMPACT.
+
+class CantoShardedShelf(CantoShelf):
+    def __init__(self, filename):
+        self.shard_dir = filename + ".d"
+
+        # The generation each key's shard was written in.
+        self.shard_gens = {}
+
+        # Keys whose shards are written by the export in progress.
+        self.exporting = set()
+
+        CantoShelf.__init__(self, filename)
+
+    def key_generation(self, key):
+        return self.shard_gens.get(key, 0)
+
+    def shard_name(self, key):
+        digest = hashlib.sha1(key.encode("UTF-8")).hexdigest()
+        return self.shard_dir + "/" + digest + ".gz"
+
+    def read_shard(self, path):
+        fp = gzip.open(path, "rt", 9, "UTF-8")
+        try:
+            return json.load(fp)
+        finally:
+            fp.close()
+
+    def write_shard(self, key, value):
+        f, tmpname = tempfile.mkstemp("", "shard", self.shard_dir)
+        os.close(f)
+
+        fp = gzip.open(tmpname, "wt", 6, "UTF-8")
+        json.dump([ key, value, self.generation ], fp)
+        fp.close()
+
+        os.rename(tmpname, self.shard_name(key))
+        self.shard_gens[key] = self.generation
+
+    # Replace the shards with the contents of the feeds file. The control
+    # shard is written last, so an import that didn't finish is done again.
+
+    def import_feeds(self):
+        log.info("Importing %s", self.filename)
+
+        if os.path.exists(self.state_name):
+            os.unlink(self.state_name)
+
+        self.shard_gens = {}
+        CantoShelf.open(self)
+        self.wait_loaded()
+
+        if not os.path.isdir(self.shard_dir):
+            os.makedirs(self.shard_dir)
+
+        self.next_generation()
+
+        keys = sorted(self.cache.keys(), key = lambda k: k == "control")
+        names = set()
+        for key in keys:
+            # The imported values are complete, write them as is.
+            CantoShardedShelf.write_shard(self, key, self.cache[key])
+            names.add(self.shard_name(key))
+
+        for f in os.listdir(self.shard_dir):
+            path = self.shard_dir + "/" + f
+            if path not in names:
+                os.unlink(path)
+
+        self.mark_exported()
+
+        self.dirty = set()
+        self.state_records = []
+        self.export_needed = False
+
+    @wlock_feeds
+    def open(self):
+        if not os.path.exists(self.shard_name("control")) or\
+                self.feeds_replaced():
+            return self.import_feeds()
+
+        call_hook("daemon_db_open", [self.filename])
+
+        paths = [ self.shard_dir + "/" + f for f in os.listdir(self.shard_dir)\
+                if f.endswith(".gz") ]
+
+        # Decompression releases the GIL, so this is worth doing in parallel
+        # even in threads.
+
+        pool = ThreadPoolExecutor(max_workers = cpu_count())
+        futures = [ (path, pool.submit(self.read_shard, path)) for path in paths ]
+
+        self.cache = {}
+        for path, future in futures:
+            try:
+                shard = future.result()
+
+                # Shards from before generations were tracked.
+                if len(shard) == 2:
+                    shard.append(0)
+
+                key, value, gen = shard
+                self.cache[key] = value
+                self.shard_gens[key] = gen
+                self.generation = max(self.generation, gen)
+            except Exception as e:
+                log.error("Failed to load shard %s: %s", path, e)
+
+        pool.shutdown()
+
+        log.debug("Loaded %d shards", len(self.cache))
+
+        self.check_control_data()
+
+        if os.path.exists(self.state_name):
+            self.replay(self.state_name)
+
+        self.dirty = set()
+        self.export_needed = not (os.path.exists(self.export_name) and\
+                os.path.exists(self.filename))
+
+    def prepare_sync(self, full):
+        if self.cache == {}:
+            return None
+
+        if full and self.export_needed:
+            return self.prepare_export()
+
+        if not (self.dirty or self.state_records):
+            return None
+
+        self.next_generation()
+
+        # Rewriting every shard makes the state journal redundant.
+
+        if self.state_size() >= STATE_MIN_COMPACT or\
+                self.dirty >= set(self.cache.keys()):
+            snap = self.snapshot(set(self.cache.keys()) | self.dirty)
+            self.dirty = set()
+            self.state_records = []
+            return (self.compact_shards, snap, [])
+
+        snap = self.snapshot(self.dirty)
+        self.dirty = set()
+        records = self.take_state_records(snap)
+        return (self.write_shards, snap, records)
+
+    def write_shards(self, snap, records):
+        for key in snap:
+            if snap[key] != None:
+                self.write_shard(key, snap[key])
+            elif os.path.exists(self.shard_name(key)):
+                os.unlink(self.shard_name(key))
+                self.shard_gens.pop(key, None)
+
+        log.debug("Wrote %d shards.", len(snap))
+
+        if records:
+            self.append_records(self.state_name, records)
+
+    def compact_shards(self, snap, records):
+        self.write_shards(snap, records)
+
+        if os.path.exists(self.state_name):
+            os.unlink(self.state_name)
+        log.debug("Compacted state journal.")
+
+    # Exporting writes every changed shard, folding in the state journal, and
+    # then the whole snapshot to the feeds file.
+
+    def prepare_export(self):
+        self.next_generation()
+
+        self.exporting = self.dirty | set([ "control" ]) |\
+                set([ URL for URL, id, attrs in self.state_records ])
+
+        snap = self.snapshot(set(self.cache.keys()) | self.dirty)
+        self.dirty = set()
+        self.state_records = []
+        self.export_needed = False
+        return (self.export_shards, snap, [])
+
+    def export_shards(self, snap, records):
+        try:
+            keys = self.exporting
+            if os.path.exists(self.state_name):
+                keys = keys | set([ r[2] for r in self.read_records(self.state_name) ])
+
+            self.compact_shards(dict([ (key, snap.get(key)) for key in keys ]), [])
+
+            self.write_snapshot(dict([ (key, snap[key]) for key in snap\
+                    if snap[key] != None ]))
+            self.mark_exported()
+        except:
+            self.export_needed = True
+            raise
+
+        log.debug("Exported %d keys.", len(snap))
+
+# The lazy shelf is a sharded shelf that only keeps item metadata (see
+# LAZY_ATTRIBUTES) in memory. The rest of each item (summaries, content, etc.)
+# is read back from the feed's shard when it's asked for, and the last few
+# feeds read are kept in an LRU cache.
+
+# Content that hasn't been written to a shard yet is held until the next sync.
+
+LAZY_ATTRIBUTES = [ "id", "title", "canto_update" ]
+LAZY_CACHE_FEEDS = 8
+
+class CantoLazyShelf(CantoShardedShelf):
+    def __init__(self, filename):
+        # { key : { id : entry } } of content not written to a shard yet.
+        self.bodies = {}
+
+        # Bodies being written by the current sync.
+        self.flushing = {}
+
+        self.lru = OrderedDict()
+        self.lru_lock = Lock()
+
+        CantoShardedShelf.__init__(self, filename)
+
+    def is_feed(self, value):
+        return type(value) == dict and type(value.get("entries")) == list
+
+    def is_resident(self, attr):
+        return attr in LAZY_ATTRIBUTES or attr.startswith("canto")
+
+    def strip_entry(self, entry):
+        r = {}
+        for key in entry:
+            if self.is_resident(key):
+                r[key] = entry[key]
+        return r
+
+    def strip(self, value):
+        if not self.is_feed(value):
+            return value
+
+        value = value.copy()
+        value["entries"] = [ self.strip_entry(e) for e in value["entries"] ]
+        return value
+
+    # Imported content has all been written to shards, so only the metadata
+    # needs to be kept.
+
+    def import_feeds(self):
+        with self.lru_lock:
+            self.bodies = {}
+            self.lru = OrderedDict()
+
+        CantoShardedShelf.import_feeds(self)
+
+        for key in self.cache:
+            self.cache[key] = self.strip(self.cache[key])
+
+    def read_shard(self, path):
+        key, value, *gen = CantoShardedShelf.read_shard(self, path)
+        return [ key, self.strip(value) ] + gen
+
+    # Return { id : entry } of the full, on disk entries for key.
+
+    def read_bodies(self, key):
+        path = self.shard_name(key)
+        if not os.path.exists(path):
+            return {}
+
+        value = CantoShardedShelf.read_shard(self, path)[1]
+        if not self.is_feed(value):
+            return {}
+        return dict([ (e["id"], e) for e in value["entries"] ])
+
+    # Return the pending and on disk bodies for key. Shards are read with the
+    # LRU locked, so a shard being replaced can't leave stale content in it.
+
+    def cached_bodies(self, key):
+        with self.lru_lock:
+            pending = self.bodies.get(key, {})
+
+            if key in self.lru:
+                self.lru.move_to_end(key)
+            else:
+                self.lru[key] = self.read_bodies(key)
+                while len(self.lru) > LAZY_CACHE_FEEDS:
+                    self.lru.popitem(False)
+
+            return (pending, self.lru[key])
+
+    # New feed content from index() mixes fresh entries with old, resident
+    # entries that were kept. The old ones are stripped, so their content has
+    # to come from what's already pending, or the shard.
+
+    def __setitem__(self, name, value):
+        if self.is_feed(value):
+            resident = set()
+            if self.is_feed(self.cache.get(name)):
+                resident = set([ id(e) for e in self.cache[name]["entries"] ])
+            pending = self.bodies.get(name, {})
+
+            bodies = {}
+            for e in value["entries"]:
+                if id(e) not in resident:
+                    bodies[e["id"]] = e
+                elif e["id"] in pending:
+                    bodies[e["id"]] = pending[e["id"]]
+
+            self.bodies[name] = bodies
+            value = self.strip(value)
+        CantoShardedShelf.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        with self.lru_lock:
+            self.bodies.pop(name, None)
+            self.lru.pop(name, None)
+        CantoShardedShelf.__delitem__(self, name)
+
+    # The full entry is the content on disk (or waiting to be written), updated
+    # with the resident metadata, which is always the most recent.
+
+    def get_entries(self, URL, ids, attributes=None):
+        resident = CantoShardedShelf.get_entries(self, URL, ids)
+
+        if attributes != None:
+            for attr in attributes:
+                if not self.is_resident(attr):
+                    break
+            else:
+                return resident
+
+        pending, disk = self.cached_bodies(URL)
+
+        r = {}
+        for id in resident:
+            if id in pending:
+                r[id] = pending[id].copy()
+            else:
+                r[id] = disk.get(id, {}).copy()
+            r[id].update(resident[id])
+        return r
+
+    def prepare_sync(self, full):
+        job = CantoShardedShelf.prepare_sync(self, full)
+        if job:
+            self.flushing = {}
+            for key in job[1]:
+                if key in self.bodies:
+                    self.flushing[key] = self.bodies[key]
+        return job
+
+    # Return the full value of feed key, from the content being synced, or
+    # the shard.
+
+    def full_value(self, key, value):
+        bodies = self.flushing.get(key)
+        old = None
+
+        entries = []
+        for entry in value["entries"]:
+            if bodies and entry["id"] in bodies:
+                full = bodies[entry["id"]].copy()
+            else:
+                if old == None:
+                    old = self.read_bodies(key)
+                full = old.get(entry["id"], {}).copy()
+            full.update(entry)
+            entries.append(full)
+
+        value = value.copy()
+        value["entries"] = entries
+        return value
+
+    # By the time the feeds file is written, every changed shard has been.
+
+    def export_value(self, key, snap):
+        if not self.is_feed(snap[key]):
+            return snap[key]
+        return self.full_value(key, snap[key])
+
+    def write_shard(self, key, value):
+        if not self.is_feed(value):
+            return CantoShardedShelf.write_shard(self, key, value)
+
+        bodies = self.flushing.get(key)
+        CantoShardedShelf.write_shard(self, key, self.full_value(key, value))
+
+        # Unless it's been replaced since, the content is on disk now.
+
+        with self.lru_lock:
+            self.lru.pop(key, None)
+            if bodies and self.bodies.get(key) is bodies:
+                del self.bodies[key]
+
+# The SQLite shelf keeps feed entries as rows keyed by (feed URL, item id) in
+# feeds.sqlite, so item lookups and attribute changes only touch the rows
+# involved. Feed level data (everything but "entries") and other keys like
+# "control" are kept in a simple key / value table.
+
+# Changes are written immediately, but only committed on sync().
+
+# If feeds.sqlite doesn't exist yet, or the feeds file has been replaced since
+# it was last exported, the contents of the gzip feeds file are imported into
+# it. A full sync exports the database back to the feeds file.
+
+SQL_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS shelf (key TEXT PRIMARY KEY, feed INTEGER, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS items (url TEXT, id TEXT, position INTEGER, canto_update REAL, state TEXT, data TEXT, PRIMARY KEY (url, id))",
+    "CREATE INDEX IF NOT EXISTS items_by_id ON items (id)",
+    "CREATE INDEX IF NOT EXISTS items_by_update ON items (canto_update)",
+    "CREATE INDEX IF NOT EXISTS items_by_state ON items (state)",
+    "CREATE INDEX IF NOT EXISTS items_by_position ON items (url, position)",
+]
+
+# Keep IN (...) clauses under SQLite's default variable limit.
+SQL_CHUNK = 500
+
+class CantoSQLShelf(CantoShelf):
+    def __init__(self, filename):
+        self.db_name = filename + ".sqlite"
+        self.db = None
+        self.db_lock = Lock()
+        CantoShelf.__init__(self, filename)
+
+    def is_feed(self, value):
+        return type(value) == dict and type(value.get("entries")) == list
+
+    def entry_row(self, URL, position, entry):
+        state = entry.get("canto-state", [])
+        if type(state) != list:
+            state = []
+        return (URL, entry["id"], position, entry.get("canto_update", 0),
+                ",".join(sorted(state)), json.dumps(entry))
+
+    @wlock_feeds
+    def open(self):
+        self.db = sqlite3.connect(self.db_name, check_same_thread = False)
+        for statement in SQL_SCHEMA:
+            self.db.execute(statement)
+
+        # Control data is only missing if a migration didn't finish.
+
+        migrate = self.feeds_replaced() or not self.db.execute(\
+                "SELECT 1 FROM shelf WHERE key = 'control'").fetchone()
+
+        journaled = False
+        if migrate:
+            log.info("Migrating %s to %s", self.filename, self.db_name)
+            journaled = os.path.exists(self.state_name)
+
+            # Loads the old file into self.cache and calls daemon_db_open.
+            CantoShelf.open(self)
+            self.wait_loaded()
+        else:
+            call_hook("daemon_db_open", [self.filename])
+
+        if migrate:
+            old = self.cache
+            self.cache = {}
+            self.db.execute("DELETE FROM shelf")
+            self.db.execute("DELETE FROM items")
+            for key in old:
+                self._store(key, old[key])
+            self.db.commit()
+            self.mark_exported()
+
+            # The state journal is in the database now. It mustn't be replayed
+            # over a later export, which has to include it instead.
+
+            if journaled:
+                os.unlink(self.state_name)
+
+        # Only non-feed keys are kept in memory.
+
+        self.cache = {}
+        for key, value in self.db.execute("SELECT key, value FROM shelf WHERE feed = 0"):
+            self.cache[key] = json.loads(value)
+
+        self.check_control_data()
+        self.dirty = set()
+        self.export_needed = journaled or not\
+                (os.path.exists(self.export_name) and os.path.exists(self.filename))
+
+    def _store(self, name, value):
+        with self.db_lock:
+            self.db.execute("DELETE FROM items WHERE url = ?", (name,))
+
+            if self.is_feed(value):
+                meta = value.copy()
+                del meta["entries"]
+
+                self.db.execute("INSERT OR REPLACE INTO shelf VALUES (?, 1, ?)",
+                        (name, json.dumps(meta)))
+                self.db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)",
+                        [ self.entry_row(name, i, e) for (i, e) in enumerate(value["entries"]) ])
+            else:
+                self.db.execute("INSERT OR REPLACE INTO shelf VALUES (?, 0, ?)",
+                        (name, json.dumps(value)))
+                self.cache[name] = value
+
+    def __setitem__(self, name, value):
+        self._store(name, value)
+        self.dirty.add(name)
+        self.update_mod()
+
+    def __getitem__(self, name):
+        if name in self.cache:
+            return self.cache[name]
+
+        with self.db_lock:
+            row = self.db.execute("SELECT value FROM shelf WHERE key = ?",
+                    (name,)).fetchone()
+            if not row:
+                raise KeyError(name)
+
+            value = json.loads(row[0])
+            value["entries"] = [ json.loads(data) for (data,) in\
+                    self.db.execute("SELECT data FROM items WHERE url = ? ORDER BY position", (name,)) ]
+
+        return value
+
+    def __contains__(self, name):
+        if name in self.cache:
+            return True
+
+        with self.db_lock:
+            row = self.db.execute("SELECT 1 FROM shelf WHERE key = ?",
+                    (name,)).fetchone()
+        return row != None
+
+    def __delitem__(self, name):
+        with self.db_lock:
+            self.db.execute("DELETE FROM shelf WHERE key = ?", (name,))
+            self.db.execute("DELETE FROM items WHERE url = ?", (name,))
+        if name in self.cache:
+            del self.cache[name]
+        self.dirty.add(name)
+        self.update_mod()
+
+    def get_entries(self, URL, ids, attributes=None):
+        r = {}
+        ids = list(ids)
+
+        with self.db_lock:
+            for i in range(0, len(ids), SQL_CHUNK):
+                chunk = ids[i:i + SQL_CHUNK]
+                query = "SELECT id, data FROM items WHERE url = ? AND id IN (%s)" %\
+                        ",".join("?" * len(chunk))
+
+                for id, data in self.db.execute(query, [ URL ] + chunk):
+                    r[id] = json.loads(data)
+        return r
+
+    def set_entry_attributes(self, URL, attributes):
+        self.unshare(URL)
+
+        entries = self.get_entries(URL, list(attributes.keys()))
+
+        with self.db_lock:
+            for id in entries:
+                entries[id].update(attributes[id])
+                row = self.entry_row(URL, 0, entries[id])
+
+                self.db.execute("UPDATE items SET canto_update = ?, state = ?, data = ? WHERE url = ? AND id = ?",
+                        (row[3], row[4], row[5], URL, id))
+
+        self.dirty.add(URL)
+        self.update_mod()
+
+        return list(entries.values())
+
+    def sync(self, full=False):
+        with self.sync_lock:
+            if not self.db:
+                return
+
+            self.dirty_since = 0
+
+            with self.db_lock:
+                for key in self.cache:
+                    self.db.execute("INSERT OR REPLACE INTO shelf VALUES (?, 0, ?)",
+                            (key, json.dumps(self.cache[key])))
+                self.db.commit()
+
+            log.debug("Committed %d keys.", len(self.dirty))
+            self.dirty = set()
+
+            if full and self.export_needed:
+                self.export()
+
+    # Feeds are read back from the database one at a time as they're written,
+    # rather than all being held in memory.
+
+    def export_value(self, key, snap):
+        return self[key]
+
+    def export(self):
+        self.export_needed = False
+
+        with self.db_lock:
+            keys = [ key for (key,) in self.db.execute("SELECT key FROM shelf") ]
+
+        try:
+            self.write_snapshot(dict([ (key, None) for key in keys ]))
+            self.mark_exported()
+            log.debug("Exported %d keys.", len(keys))
+        except Exception as e:
+            log.error("Failed to export: %s" % e)
+            self.export_needed = True
+
+    def close(self):
+        log.debug("Closing.")
+        self.sync(True)
+        self.db.close()
+        self.db = None
+        self.cache = {}
+        call_hook("daemon_db_close", [self.filename])
+
+# The sync scheduler periodically persists the shelf from its own thread,
+# coalescing bursts of changes (fetches, SETATTRIBUTES) into single syncs.
+
+class CantoSyncScheduler(Thread):
+    def __init__(self, shelf):
+        Thread.__init__(self, name = "Sync scheduler")
+        self.daemon = True
+
+        self.shelf = shelf
+        self.stopped = Event()
+        self.last_sync = 0
+
+        self.syncs = 0
+        self.sync_time = 0.0
+        self.max_sync_time = 0.0
+        self.last_sync_time = 0.0
+        self.max_lock_time = 0.0
+
+    def needs_sync(self, now):
+        dirty_since = self.shelf.dirty_since
+        if not dirty_since:
+            return False
+
+        if now - self.last_sync < SYNC_MIN_INTERVAL:
+            return False
+
+        if now - dirty_since >= SYNC_MAX_LATENCY:
+            return True
+
+        return now - self.shelf.last_change >= SYNC_DEBOUNCE
+
+    def sync(self):
+        start = time.time()
+
+        self.shelf.sync()
+        self.shelf.wait_writer()
+
+        self.last_sync = time.time()
+        duration = self.last_sync - start
+
+        self.syncs += 1
+        self.sync_time += duration
+        self.last_sync_time = duration
+        self.max_sync_time = max(self.max_sync_time, duration)
+        self.max_lock_time = max(self.max_lock_time, self.shelf.lock_time)
+
+        log.debug("Scheduled sync took %.3fs", duration)
+
+    def run(self):
+        while not self.stopped.wait(SYNC_TICK):
+            try:
+                if self.needs_sync(time.time()):
+                    self.sync()
+            except Exception as e:
+                log.error("Scheduled sync failed: %s" % e)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def stats(self):
+        avg = 0.0
+        if self.syncs:
+            avg = self.sync_time / self.syncs
+
+        return { "syncs" : self.syncs,
+                 "avg_time" : avg,
+                 "last_time" : self.last_sync_time,
+                 "max_time" : self.max_sync_time,
+                 "max_lock_time" : self.max_lock_time }
+
+storage_types = {
+        "gzip" : CantoShelf,
+        "journal" : CantoJournalShelf,
+        "sharded" : CantoShardedShelf,
+        "lazy" : CantoLazyShelf,
+}
+
+if sqlite3:
+    storage_types["sqlite"] = CantoSQLShelf
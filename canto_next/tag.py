@@ -8,16 +8,47 @@
 from .hooks import on_hook, call_hook
 from .rwlock import read_lock, write_lock
 from .locks import *
+from .ids import allids
 
+import tempfile
 import logging
+import json
+import gzip
+import os
 
 log = logging.getLogger("TAG")
 
 class CantoTags():
     def __init__(self):
+        # { tag : { id : None } } each tag is an ordered set of ids, in the
+        # order they'll be presented. get_tag() returns them as a list.
+
         self.tags = {}
         self.changed_tags = []
 
+        # { id : { tag : None } } reverse of self.tags, so finding an item's
+        # tags doesn't mean searching every tag.
+
+        self.item_tags = {}
+
+        # { tag : { id : None } } ids added to each tag since it was last
+        # transformed, see do_tag_changes.
+
+        self.dirty = {}
+
+        # { state : { id : None } } the items with each canto-state, and
+        # { id : ( states ) } the other way around. Kept up to date by the
+        # feeds as items are indexed or have their attributes set, so
+        # StateFilter doesn't have to fetch canto-state.
+
+        self.state_items = {}
+        self.item_states = {}
+
+        # { tag : { state : count } } how many items in each tag have each
+        # state, see tag_counts().
+
+        self.state_counts = {}
+
         # Per-tag transforms
         self.tag_transforms = {}
 
@@ -28,23 +59,43 @@ class CantoTags():
 
         self.extra_tags = {}
 
+        # { URL : { tag : { id : None } } } the ids each feed last put in each
+        # tag, in order. Lets feeds work out what actually changed when they're
+        # re-indexed.
+
+        self.feed_members = {}
+
+        # Whether the tags were loaded whole from disk (see load), rather than
+        # built up by indexing the feeds.
+
+        self.loaded = False
+
     def items_to_tags(self, ids):
-        tags = []
+        tags = {}
         for id in ids:
-            for tag in self.tags:
-                if id in self.tags[tag] and tag not in tags:
-                    tags.append(tag)
-        return tags
+            if id in self.item_tags:
+                tags.update(self.item_tags[id])
+        return list(tags.keys())
 
     def tag_changed(self, tag):
         if tag not in self.changed_tags:
             self.changed_tags.append(tag)
 
     def get_tag(self, tag):
-        if tag in list(self.tags.keys()):
-            return self.tags[tag]
+        if tag in self.tags:
+            return list(self.tags[tag].keys())
         return []
 
+    def has_state(self, id, state):
+        return state in self.item_states.get(id, ())
+
+    # Return { "total" : items, state : items with state, ... } for tag.
+
+    def tag_counts(self, tag):
+        counts = { "total" : len(self.tags.get(tag, {})) }
+        counts.update(self.state_counts.get(tag, {}))
+        return counts
+
     def get_tags(self):
         return list(self.tags.keys())
 
@@ -56,6 +107,97 @@ class CantoTags():
 
     def clear_tags(self):
         self.tags = {}
+        self.item_tags = {}
+        self.dirty = {}
+        self.state_items = {}
+        self.item_states = {}
+        self.state_counts = {}
+        self.feed_members = {}
+        self.loaded = False
+
+    # Whether the tags hold all of the items of the feeds at URLs. That is,
+    # they were loaded whole, or each of the feeds has been indexed since the
+    # tags were last cleared.
+
+    def complete(self, URLs):
+        if self.loaded:
+            return True
+
+        for URL in URLs:
+            if URL not in self.feed_members:
+                return False
+        return True
+
+    # Save the current tags to path, with a stamp describing the state of
+    # everything they were built from (see CantoBackend.tags_stamp). Ids are
+    # saved as [ URL, ID ] pairs, since handles don't survive a restart.
+
+    def save(self, path, stamp):
+        f, tmpname = tempfile.mkstemp("", "tags", os.path.dirname(path))
+        os.close(f)
+
+        tags = {}
+        for tag in self.tags:
+            tags[tag] = [ allids.key(id) for id in self.tags[tag] ]
+
+        states = {}
+        for state in self.state_items:
+            states[state] = [ allids.key(id) for id in self.state_items[state] ]
+
+        fp = gzip.open(tmpname, "wt", 6, "UTF-8")
+        json.dump({ "stamp" : stamp, "tags" : tags, "states" : states }, fp)
+        fp.close()
+
+        os.rename(tmpname, path)
+        log.debug("Saved %d tags", len(self.tags))
+
+    # Load tags saved with a matching stamp. Returns False if they couldn't
+    # be used and have to be rebuilt from the feeds.
+
+    def load(self, path, stamp):
+        if not os.path.exists(path):
+            return False
+
+        try:
+            fp = gzip.open(path, "rt", 6, "UTF-8")
+            try:
+                saved = json.load(fp)
+            finally:
+                fp.close()
+        except Exception as e:
+            log.error("Failed to load tags from %s: %s", path, e)
+            return False
+
+        if saved["stamp"] != stamp:
+            log.debug("Saved tags are stale")
+            return False
+
+        try:
+            tags = {}
+            for tag in saved["tags"]:
+                tags[tag] = dict.fromkeys([ allids.intern(URL, ID)\
+                        for URL, ID in saved["tags"][tag] ])
+
+            item_states = {}
+            for state in saved["states"]:
+                for URL, ID in saved["states"][state]:
+                    item_states.setdefault(allids.intern(URL, ID), []).append(state)
+        except Exception as e:
+            log.error("Bad saved tags in %s: %s", path, e)
+            return False
+
+        self.clear_tags()
+        for id in item_states:
+            self.set_item_states(id, item_states[id])
+        for tag in tags:
+            self.tags[tag] = tags[tag]
+            for id in tags[tag]:
+                self._add_member(id, tag)
+        call_hook("daemon_new_tag", [ list(self.tags.keys()) ])
+        self.loaded = True
+
+        log.debug("Loaded %d tags", len(self.tags))
+        return True
 
     def reset(self):
         self.tag_transforms = {}
@@ -68,64 +210,223 @@ class CantoTags():
 
         self.clear_tags()
 
+    # Return name, plus any tags it's a part of.
+
+    def tag_and_extras(self, name):
+        if name in self.extra_tags:
+            return [ name ] + self.extra_tags[name]
+        return [ name ]
+
     #
     # Following must be called with tag_lock held with write
     #
 
-    def add_tag(self, id, name):
-        if name in self.extra_tags:
-            extras = self.extra_tags[name]
+    # Keep item_tags up to date, these don't touch self.tags
+
+    def _add_member(self, id, name):
+        if id in self.item_tags:
+            self.item_tags[id][name] = None
+        else:
+            self.item_tags[id] = { name : None }
+
+        for state in self.item_states.get(id, ()):
+            self._count_state(name, state, 1)
+
+    def _remove_member(self, id, name):
+        tags = self.item_tags[id]
+        del tags[name]
+        if not tags:
+            del self.item_tags[id]
+
+        for state in self.item_states.get(id, ()):
+            self._count_state(name, state, -1)
+
+    def _count_state(self, name, state, n):
+        counts = self.state_counts.setdefault(name, {})
+        counts[state] = counts.get(state, 0) + n
+        if not counts[state]:
+            del counts[state]
+            if not counts:
+                del self.state_counts[name]
+
+    # Record item id's canto-state.
+
+    def set_item_states(self, id, states):
+        old = self.item_states.get(id, ())
+        new = tuple(sorted(set(states)))
+        if old == new:
+            return
+
+        if new:
+            self.item_states[id] = new
         else:
-            extras = []
+            del self.item_states[id]
+
+        tags = self.item_tags.get(id, {})
+
+        for state in old:
+            if state not in new:
+                ids = self.state_items[state]
+                del ids[id]
+                if not ids:
+                    del self.state_items[state]
+                for tag in tags:
+                    self._count_state(tag, state, -1)
+
+        for state in new:
+            if state not in old:
+                self.state_items.setdefault(state, {})[id] = None
+                for tag in tags:
+                    self._count_state(tag, state, 1)
+
+    def _new_tag(self, name):
+        self.tags[name] = {}
+        call_hook("daemon_new_tag", [[ name ]])
+
+    def _mark_dirty(self, id, name):
+        if name in self.dirty:
+            self.dirty[name][id] = None
+        else:
+            self.dirty[name] = { id : None }
 
-        alladded = [ name ] + extras
+    def add_tag(self, id, name):
+        alladded = self.tag_and_extras(name)
 
         for name in alladded:
             # Create tag if no tag exists
             if name not in self.tags:
-                self.tags[name] = []
-                call_hook("daemon_new_tag", [[ name ]])
+                self._new_tag(name)
 
             # Add to tag.
             if id not in self.tags[name]:
-                self.tags[name].append(id)
+                self.tags[name][id] = None
+                self._add_member(id, name)
+                self._mark_dirty(id, name)
                 self.tag_changed(name)
 
     def remove_tag(self, id, name):
         if name in self.tags and id in self.tags[name]:
-            self.tags[name].remove(id)
+            del self.tags[name][id]
+            self._remove_member(id, name)
             self.tag_changed(name)
 
+    # Remove the ids in remove from tag name, then add the ids in add, in
+    # order, to the end.
+
+    def update_tag(self, name, remove, add):
+        if name not in self.tags:
+            if not add:
+                return
+            self._new_tag(name)
+
+        tag = self.tags[name]
+
+        for id in remove:
+            if id in tag:
+                del tag[id]
+                self._remove_member(id, name)
+
+        for id in add:
+            if id not in tag:
+                tag[id] = None
+                self._add_member(id, name)
+                self._mark_dirty(id, name)
+
+        self.tag_changed(name)
+
     def remove_id(self, id):
-        for tag in self.tags:
-            if id in self.tags[tag]:
-                self.tags[tag].remove(id)
-                self.tag_changed(tag)
+        if id not in self.item_tags:
+            return
 
-    def apply_transforms(self, tag, tagobj):
+        for tag in self.item_tags.pop(id):
+            del self.tags[tag][id]
+            for state in self.item_states.get(id, ()):
+                self._count_state(tag, state, -1)
+            self.tag_changed(tag)
+
+    def get_transforms(self, tag):
         from .config import config
+        transforms = []
+
         # Global transform
         if config.global_transform:
-            tagobj = config.global_transform(tagobj)
+            transforms.append(config.global_transform)
 
         # Tag level transform
         if tag in self.tag_transforms and\
                 self.tag_transforms[tag]:
-            tagobj = self.tag_transforms[tag](tagobj)
+            transforms.append(self.tag_transforms[tag])
+
+        return transforms
 
+    # The transforms share one attribute cache (see CantoTransform).
+
+    def apply_transforms(self, tag, tagobj):
+        attrs = {}
+        for transform in self.get_transforms(tag):
+            tagobj = transform(tagobj, attrs)
         return tagobj
 
+    # If all of a tag's transforms are filters, the items that have been in
+    # the tag since it was last transformed have already passed them, so we
+    # only have to filter the dirty items and take out the ones that fail.
+    # Otherwise (sorts, limits) the whole tag has to be transformed again.
+
+    def incremental(self, tag):
+        for transform in self.get_transforms(tag):
+            if not hasattr(transform, "incremental") or\
+                    not transform.incremental():
+                return False
+        return True
+
     def do_tag_changes(self):
+        # Let anything caching per-item information (like sort keys) know
+        # which items have been (re-)added because they changed.
+
+        changed = {}
         for tag in self.changed_tags:
-            tagobj = self.get_tag(tag)
+            if tag in self.dirty:
+                changed.update(self.dirty[tag])
+        if changed:
+            call_hook("daemon_items_changed", [ list(changed.keys()) ])
+
+        for tag in self.changed_tags:
+            dirty = self.dirty.pop(tag, {})
 
             try:
-                tagobj = self.apply_transforms(tag, tagobj)
+                if self.incremental(tag):
+                    items = [ id for id in dirty if id in self.tags[tag] ]
+                    if items:
+                        kept = set(self.apply_transforms(tag, items))
+                        for id in items:
+                            if id not in kept:
+                                del self.tags[tag][id]
+                                self._remove_member(id, tag)
+                else:
+                    tagobj = self.apply_transforms(tag, self.get_tag(tag))
+                    self._set_tag(tag, tagobj)
             except Exception as e:
                 log.error("Exception applying transforms: %s" % e)
 
-            self.tags[tag] = tagobj
+                # Leave the untransformed items to be tried again.
+                self.dirty[tag] = dirty
+
             call_hook("daemon_tag_change", [ tag ])
         self.changed_tags = []
 
+    # Replace the content of tag with the ids in tagobj, in order.
+
+    def _set_tag(self, tag, tagobj):
+        old = self.tags.get(tag, {})
+        new = dict.fromkeys(tagobj)
+
+        for id in old:
+            if id not in new:
+                self._remove_member(id, tag)
+        for id in new:
+            if id not in old:
+                self._add_member(id, tag)
+
+        self.tags[tag] = new
+
 alltags = CantoTags()
@@ -8,8 +8,13 @@
 
 from .feed import allfeeds
 from .tag import alltags
+from .search import allsearch, tokenize
+from .hooks import on_hook
+from .ids import allids
 
+from threading import Lock
 import logging
+import heapq
 import re
 
 log = logging.getLogger("TRANSFORM")
@@ -19,10 +24,39 @@ transform_locals = { }
 # A Transform is generically any form of manipulation of the number of items
 # (filter) or order of those items (sort) based on some criteria.
 
+# Fill attrs ({ id : { attribute : value } }) with the needed attributes for
+# items, only fetching the ones that aren't already there.
+
+def fetch_attributes(items, needed, attrs):
+    want = {}
+    for item in items:
+        if item not in attrs:
+            want[item] = needed
+        else:
+            missing = [ a for a in needed if a not in attrs[item] ]
+            if missing:
+                want[item] = missing
+
+    if not want:
+        return
+
+    f = allfeeds.items_to_feeds(list(want.keys()))
+    for feed in f:
+        got = feed.get_attributes(f[feed], want)
+        for item in got:
+            if item in attrs:
+                attrs[item].update(got[item])
+            else:
+                attrs[item] = got[item]
+
 # The CantoTransform class serves as the base of all Transforms. It takes the
 # elements returned by a class' `needed_attributes()`, populates a dict of
 # these elements from cache/disk, and then gives them to the `transform()` call.
 
+# When transforms are chained (global transform, tag transform, socket
+# transforms) the caller passes the same attrs dict to each of them, so
+# attributes needed by more than one are only fetched once.
+
 class CantoTransform():
     def __init__(self, name):
         self.name = name
@@ -32,23 +66,22 @@ class CantoTransform():
 
     # This is called with the feeds already read locked.
 
-    def __call__(self, tag):
-        a = {}
-        f = allfeeds.items_to_feeds(tag)
+    def __call__(self, tag, attrs=None):
+        if attrs == None:
+            attrs = {}
+
         needed = self.needed_attributes(tag)
+        if not needed:
+            return self.transform(tag, attrs)
 
-        for feed in f:
-            attrs = {}
-            for i in f[feed]:
-                attrs[i] = needed
-            a.update(feed.get_attributes(f[feed], attrs))
+        fetch_attributes(tag, needed, attrs)
 
         for item in tag[:]:
-            if item not in a.keys():
+            if item not in attrs:
                 log.warn("Missing attributes for %s" % item)
                 tag.remove(item)
 
-        return self.transform(tag, a)
+        return self.transform(tag, attrs)
 
     def needed_attributes(self, tag):
         return []
@@ -56,69 +89,216 @@ class CantoTransform():
     def transform(self, items, attrs):
         return items
 
+    # Whether this transform's result can be worked out an item at a time (see
+    # CantoFilter).
+
+    def incremental(self):
+        return False
+
+# A CantoFilter is a transform that just decides, item by item, whether to keep
+# each item, without reordering. Filters implement keep() instead of
+# transform().
+
+# Because an item's verdict only depends on that item, tags with only filters
+# applied don't have to be re-filtered in full when they change. Only the
+# items that have been added (or re-added because they changed) since the tag
+# was last filtered need to be run through keep() (see
+# CantoTags.do_tag_changes).
+
+class CantoFilter(CantoTransform):
+    def transform(self, items, attrs):
+        return [ i for i in items if self.keep(i, attrs) ]
+
+    def keep(self, item, attrs):
+        return True
+
+    def incremental(self):
+        return True
+
 # A StateFilter will filter out items that match a particular state. Supports
 # using "-tag" to indicate to filter out those missing the tag.
 
-class StateFilter(CantoTransform):
+class StateFilter(CantoFilter):
     def __init__(self, state):
-        CantoTransform.__init__(self, "Filter state: %s" % state)
+        CantoFilter.__init__(self, "Filter state: %s" % state)
         self.state = state
 
-    def needed_attributes(self, tag):
-        return ["canto-state"]
-
-    def transform(self, items, attrs):
-        if self.state[0] == "-":
-            state = self.state[1:]
-            keep = True
+        if state[0] == "-":
+            self.match_state = state[1:]
+            self.keep_match = True
         else:
-            state = self.state
-            keep = False
+            self.match_state = state
+            self.keep_match = False
+
+    # CantoTags knows every item's state, no need to fetch them.
+
+    def keep(self, item, attrs):
+        return alltags.has_state(item, self.match_state) == self.keep_match
+
+# Match text against any number of ContentFilter strings and ContentFilterRegex
+# regexes at once.
+
+# A ContentFilter for X used to be the regex ".*X.*" run with match(), which
+# is true if X appears before the first newline (. doesn't match newlines).
+# We can tell that with a plain substring search instead. Several strings are
+# searched for with one alternation, and the earliest match is before the
+# first newline if any of them is.
+
+# Regexes are combined into one alternation too, unless they have groups
+# (which could have backreferences that would be renumbered) or won't combine,
+# in which case they're matched one at a time.
+
+class ContentMatcher():
+    def __init__(self, literals, regexes):
+        self.literal = None
+        self.literal_re = None
+        self.longest = -1
+
+        if len(literals) == 1:
+            self.literal = literals[0]
+        elif literals:
+            self.literal_re = re.compile("|".join(\
+                    [ re.escape(l) for l in literals ]))
+        if literals:
+            self.longest = max([ len(l) for l in literals ])
+
+        self.regexes = [ r for r in regexes if r.groups ]
+        combine = [ r for r in regexes if not r.groups ]
+
+        if len(combine) > 1:
+            try:
+                combined = re.compile("|".join(\
+                        [ "(?:%s)" % r.pattern for r in combine ]))
+                combine = [ combined ]
+            except:
+                pass
+        self.regexes = combine + self.regexes
+
+    def matches(self, text):
+        if self.longest != -1:
+            # Only matches starting on the first line count, so there's no
+            # need to look further than the longest string past it.
+            first = text.find("\n")
+            if first == -1:
+                first = end = len(text)
+            else:
+                end = first + self.longest
+
+            if self.literal != None:
+                start = text.find(self.literal, 0, end)
+            else:
+                m = self.literal_re.search(text, 0, end)
+                start = m.start() if m else -1
 
-        return [ i for i in items if \
-                (state in attrs[i]["canto-state"]) == keep]
+            if start != -1 and start <= first:
+                return True
+
+        for regex in self.regexes:
+            if regex.match(text):
+                return True
+
+        return False
 
 # Filter out items whose [attribute] content matches an arbitrary regex.
 
-class ContentFilterRegex(CantoTransform):
+class ContentFilterRegex(CantoFilter):
     def __init__(self, attribute, regex):
-        CantoTransform.__init__(self, "Filter %s in %s" % (attribute, regex))
+        CantoFilter.__init__(self, "Filter %s in %s" % (attribute, regex))
         self.attribute = attribute
+        self.literal = None
         try:
             self.match = re.compile(regex)
+            self.matcher = ContentMatcher([], [ self.match ])
         except:
             self.match = None
+            self.matcher = None
             log.error("Couldn't compile regex: %s" % regex)
 
     def needed_attributes(self, tag):
-        if not self.match:
+        if not self.matcher:
             return []
         return [ self.attribute ]
 
-    def transform(self, items, attrs):
-        if not self.match:
-            return items
+    def keep(self, item, attrs):
+        if not self.matcher:
+            return True
 
-        r = []
-        for item in items:
-            a = attrs[item]
-            if self.attribute not in a:
-                r.append(item)
-                continue
-            if type(a[self.attribute]) != str:
-                log.error("Can't match non-string!")
-                continue
-
-            if not self.match.match(a[self.attribute]):
-                r.append(item)
-        return r
+        a = attrs[item]
+        if self.attribute not in a:
+            return True
+        if type(a[self.attribute]) != str:
+            log.error("Can't match non-string!")
+            return False
+
+        return not self.matcher.matches(a[self.attribute])
 
 # Simple basic-string abstraction of the above.
 
 class ContentFilter(ContentFilterRegex):
     def __init__(self, attribute, string):
-        string = ".*" + re.escape(string) + ".*"
-        ContentFilterRegex.__init__(self, attribute, string)
+        ContentFilterRegex.__init__(self, attribute,\
+                ".*" + re.escape(string) + ".*")
+        self.literal = string
+        self.matcher = ContentMatcher([ string ], [])
+
+# Several content filters on the same attribute, checked with one
+# ContentMatcher. Used by AllTransform.
+
+class ContentFilters(ContentFilterRegex):
+    def __init__(self, filters):
+        CantoFilter.__init__(self, " AND ".join([ f.name for f in filters ]))
+        self.attribute = filters[0].attribute
+        self.match = None
+        self.literal = None
+
+        literals = [ f.literal for f in filters if f.literal != None ]
+        regexes = [ f.match for f in filters if f.literal == None ]
+        self.matcher = ContentMatcher(literals, regexes)
+
+# Return the keep() functions for filters, with content filters on the same
+# attribute combined into one.
+
+def combined_keeps(filters):
+    by_attribute = {}
+    for f in filters:
+        if isinstance(f, ContentFilterRegex) and f.matcher:
+            by_attribute.setdefault(f.attribute, []).append(f)
+
+    keeps = []
+    for f in filters:
+        if isinstance(f, ContentFilterRegex) and f.matcher:
+            group = by_attribute[f.attribute]
+            if len(group) == 1:
+                keeps.append(f.keep)
+            elif group[0] is f:
+                keeps.append(ContentFilters(group).keep)
+        else:
+            keeps.append(f.keep)
+    return keeps
+
+# { attribute : { id : value } } sort keys, kept between sorts so we don't have
+# to fetch every item's attributes every time a tag is sorted. Items that
+# change are re-added to their tags, and CantoTags tells us about them with the
+# daemon_items_changed hook so we can forget their old keys.
+
+# Sorts run from the workers and socket transforms as well as under tag_lock,
+# so the cache is only touched with sort_keys_lock held. Attributes are
+# fetched without it.
+
+SORT_KEY_CACHE = 100000
+
+sort_keys = {}
+sort_keys_lock = Lock()
+
+def forget_sort_keys(ids):
+    sort_keys_lock.acquire()
+    for attr in sort_keys:
+        keys = sort_keys[attr]
+        for id in ids:
+            keys.pop(id, None)
+    sort_keys_lock.release()
+
+on_hook("daemon_items_changed", forget_sort_keys)
 
 class SortTransform(CantoTransform):
     def __init__(self, name, attr):
@@ -126,14 +306,102 @@ class SortTransform(CantoTransform):
         self.attr = attr
 
     def needed_attributes(self, tag):
-        return [ self.attr ]
+        needed = []
+
+        sort_keys_lock.acquire()
+        keys = sort_keys.get(self.attr, {})
+        for item in tag:
+            if item not in keys:
+                needed = [ self.attr ]
+                break
+        sort_keys_lock.release()
+
+        return needed
+
+    def decorated(self, items, attrs):
+        sort_keys_lock.acquire()
+        if self.attr not in sort_keys or\
+                len(sort_keys[self.attr]) > SORT_KEY_CACHE:
+            sort_keys[self.attr] = {}
+        keys = sort_keys[self.attr]
+        known = dict([ (i, keys[i]) for i in items if i in keys ])
+        sort_keys_lock.release()
+
+        # Keys can be forgotten after needed_attributes() said we had them.
+        missing = [ i for i in items if i not in known and\
+                (i not in attrs or self.attr not in attrs[i]) ]
+        if missing:
+            fetch_attributes(missing, [ self.attr ], attrs)
+
+        r = []
+        fetched = {}
+        for item in items:
+            if item in attrs and self.attr in attrs[item]:
+                key = attrs[item][self.attr]
+                fetched[item] = key
+            else:
+                key = known[item]
+            r.append((key, item))
+
+        sort_keys_lock.acquire()
+        keys.update(fetched)
+        sort_keys_lock.release()
+
+        return r
+
+    # Items with the same key are ordered by their id strings, like they were
+    # before ids were handles. Only runs of tied items need their strings.
+
+    def break_ties(self, r):
+        i = 0
+        while i < len(r):
+            j = i + 1
+            while j < len(r) and r[j][0] == r[i][0]:
+                j += 1
+            if j - i > 1:
+                r[i:j] = sorted(r[i:j], key = lambda d: allids.to_string(d[1]))
+            i = j
 
     def transform(self, items, attrs):
-        r = [ ( attrs[item][self.attr], item ) for item in items ]
+        r = self.decorated(items, attrs)
         r.sort()
+        self.break_ties(r)
         return [ item[1] for item in r ]
 
+    # Same as transform(), followed by ItemLimit(limit), but without sorting
+    # the items that would be thrown away.
+
+    def top(self, items, attrs, limit):
+        r = self.decorated(items, attrs)
+        top = heapq.nsmallest(limit, r)
+
+        # Items tied with the last one may have been left out in favour of a
+        # lower handle, rather than a lower id string.
+
+        if top and len(r) > len(top):
+            last = top[-1][0]
+            top = [ d for d in top if d[0] != last ] +\
+                    [ d for d in r if d[0] == last ]
+
+        self.break_ties(top)
+        return [ item[1] for item in top[:limit] ]
+
+def is_filter(t):
+    return hasattr(t, "incremental") and t.incremental()
+
 # Meta-filter for AND
+
+# The children are compiled into stages when the transform is created. Runs of
+# filters are fused into a single pass that tries each item against each of
+# them in turn, stopping at the first that rejects it, instead of a pass over
+# the whole list per filter. Sorts give the same result whether filters run
+# before or after them, so filters are moved ahead of them and the sorts run
+# on what's left. Anything else (like ItemLimit) depends on what it's given, so
+# filters are never moved past it.
+
+# A sort followed by a limit only has to find the first items (see
+# SortTransform.top) and any earlier sorts don't matter.
+
 class AllTransform(CantoTransform):
     def __init__(self, *args):
         name = "("
@@ -149,6 +417,63 @@ class AllTransform(CantoTransform):
         CantoTransform.__init__(self, name)
         self.transforms = args
 
+        # Nested ANDs are just more children.
+        flat = []
+        for t in args:
+            if isinstance(t, AllTransform):
+                flat.extend(t.flat)
+            else:
+                flat.append(t)
+        self.flat = flat
+
+        self.keeps = combined_keeps([ t for t in flat if is_filter(t) ])
+
+        self.stages = []
+        filters = []
+        sorts = []
+        for t in flat:
+            if is_filter(t):
+                filters.append(t)
+            elif isinstance(t, SortTransform):
+                sorts.append(t)
+            elif isinstance(t, ItemLimit) and t.limit and sorts:
+                self.add_stages(filters, [])
+                self.stages.append(self.top_stage(sorts[-1], t.limit))
+                filters = []
+                sorts = []
+            else:
+                self.add_stages(filters, sorts)
+                self.stages.append(t.transform)
+                filters = []
+                sorts = []
+        self.add_stages(filters, sorts)
+
+    def add_stages(self, filters, sorts):
+        if filters:
+            self.stages.append(self.fused_stage(combined_keeps(filters)))
+        for sort in sorts:
+            self.stages.append(sort.transform)
+
+    def top_stage(self, sort, limit):
+        return lambda items, attrs: sort.top(items, attrs, limit)
+
+    def fused_stage(self, keeps):
+        if len(keeps) == 1:
+            keep = keeps[0]
+            return lambda items, attrs: [ i for i in items if keep(i, attrs) ]
+
+        def stage(items, attrs):
+            good_items = []
+            for item in items:
+                for keep in keeps:
+                    if not keep(item, attrs):
+                        break
+                else:
+                    good_items.append(item)
+            return good_items
+
+        return stage
+
     def needed_attributes(self, tag):
         needed = []
         for t in self.transforms:
@@ -159,12 +484,30 @@ class AllTransform(CantoTransform):
 
     def transform(self, items, attrs):
         good_items = items[:]
-        for t in self.transforms:
-            good_items = t.transform(good_items, attrs)
+        for stage in self.stages:
+            good_items = stage(good_items, attrs)
             if not good_items:
                 break
         return good_items
 
+    # If everything we're combining is a filter, so are we.
+
+    def incremental(self):
+        for t in self.flat:
+            if not is_filter(t):
+                return False
+        return True
+
+    def keep(self, item, attrs):
+        for keep in self.keeps:
+            if not keep(item, attrs):
+                return False
+        return True
+
+# Meta-filter for OR. If all of the children are filters, each item is tried
+# against them in turn until one keeps it. Otherwise, the items each child
+# returns are combined, in order.
+
 class AnyTransform(CantoTransform):
     def __init__(self, *args):
         name = "("
@@ -179,6 +522,17 @@ class AnyTransform(CantoTransform):
         CantoTransform.__init__(self, name)
         self.transforms = args
 
+        # Nested ORs are just more children.
+        flat = []
+        for t in args:
+            if isinstance(t, AnyTransform):
+                flat.extend(t.flat)
+            else:
+                flat.append(t)
+        self.flat = flat
+
+        self.keeps = [ t.keep for t in flat if is_filter(t) ]
+
     def needed_attributes(self, tag):
         needed = []
         for t in self.transforms:
@@ -187,19 +541,36 @@ class AnyTransform(CantoTransform):
                     needed.append(a)
         return needed
 
+    def incremental(self):
+        for t in self.flat:
+            if not is_filter(t):
+                return False
+        return True
+
+    def keep(self, item, attrs):
+        for keep in self.keeps:
+            if keep(item, attrs):
+                return True
+        return False
+
     def transform(self, items, attrs):
+        # Combining filters, keep the original order.
+        if self.incremental():
+            return [ i for i in items if self.keep(i, attrs) ]
+
         good_items = []
-        per_transform = []
+        seen = set()
 
         for t in self.transforms:
-            per_transform.append(t.transform(items, attrs))
-
-        for pt in per_transform:
-            for item in pt:
-                if item not in good_items:
+            for item in t.transform(items, attrs):
+                if item not in seen:
                     good_items.append(item)
+                    seen.add(item)
         return good_items
 
+# Not a filter, whether an item is kept depends on its other tags, which can
+# change without the item being dirtied in this one.
+
 class InTags(CantoTransform):
     def __init__(self, *args):
         name = "in tags: %s" % (args,)
@@ -221,6 +592,22 @@ class InTags(CantoTransform):
 
         return good
 
+# Keep only items with all of the words in terms in their title or summary.
+# Unlike the ContentFilters, this doesn't look at the content at all, it just
+# asks the search index (see search.py).
+
+class Search(CantoFilter):
+    def __init__(self, terms):
+        CantoFilter.__init__(self, "Search: %s" % terms)
+        self.terms = terms
+        self.words = tokenize(terms)
+
+    def needed_attributes(self, tag):
+        return []
+
+    def keep(self, item, attrs):
+        return allsearch.matches(item, self.words)
+
 class ItemLimit(CantoTransform):
     def __init__(self, num):
         if type(num) != int:
@@ -250,6 +637,7 @@ transform_locals["All"] = AllTransform
 transform_locals["Any"] = AnyTransform
 transform_locals["InTags"] = InTags
 transform_locals["ItemLimit"] = ItemLimit
+transform_locals["Search"] = Search
 
 transform_locals["filter_read"] = StateFilter("read")
 transform_locals["sort_alphabetical"] =\
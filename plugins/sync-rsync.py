@@ -59,6 +59,7 @@ from canto_next.config import parse_locks, parse_unlocks, config
 from canto_next.locks import config_lock, feed_lock
 from canto_next.feed import wlock_all, wunlock_all, rlock_all, runlock_all, allfeeds
 from canto_next.tag import alltags
+from canto_next.search import allsearch
 
 from tempfile import mkstemp
 import subprocess
@@ -172,7 +173,8 @@ class CantoFileSync(DaemonBackendPlugin):
 
             # Sync the shelf so it's all on disk
 
-            self.backend.shelf.sync()
+            self.backend.shelf.sync(True)
+            self.backend.shelf.wait_writer()
 
             shutil.copyfile(self.backend.feed_path, fname)
 
@@ -270,6 +272,7 @@ class CantoFileSync(DaemonBackendPlugin):
                 # configuration.
 
                 alltags.clear_tags()
+                allsearch.clear()
 
                 # First half of wunlock_all, release these locks so
                 # fetch threads can get locks
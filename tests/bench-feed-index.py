@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Time merging fetched content into large feeds (see CantoFeed._merge). Not
+# run as part of the tests, run by hand:
+#
+#   cd tests; PYTHONPATH=.. ./bench-feed-index.py
+
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.tag import alltags
+
+import logging
+import time
+
+logging.basicConfig(level = logging.WARNING)
+
+TEST_URL = "http://example.com/"
+NUM_ITEMS = 10000
+RUNS = 5
+
+def generate_entries(start, num, update_time):
+    entries = []
+    for i in range(start, start + num):
+        entries.append({ "id" : TEST_URL + "%d/" % i,
+                         "title" : "Title %d" % i,
+                         "canto_update" : update_time })
+    return entries
+
+def bench(name, old, new, keep_unread):
+    allfeeds.reset()
+    alltags.reset()
+
+    feed = CantoFeed({}, "Bench", TEST_URL, 10, 0, keep_unread)
+
+    best = None
+    for i in range(RUNS):
+        old_contents = { "entries" : [ e.copy() for e in old ] }
+        update_contents = { "canto_update" : time.time(),
+                "entries" : [ e.copy() for e in new ] }
+
+        start = time.time()
+        merged = feed._merge(update_contents, old_contents)
+        elapsed = time.time() - start
+
+        if best == None or elapsed < best:
+            best = elapsed
+
+    print("%-40s %6d entries  %8.2f ms" % (name, len(merged), best * 1000))
+
+if __name__ == "__main__":
+    old_time = time.time() - 86400
+
+    bench("same %d items refetched" % NUM_ITEMS,
+            generate_entries(0, NUM_ITEMS, old_time),
+            generate_entries(0, NUM_ITEMS, 0), False)
+
+    bench("%d new items, %d discarded" % (NUM_ITEMS, NUM_ITEMS),
+            generate_entries(0, NUM_ITEMS, old_time),
+            generate_entries(NUM_ITEMS, NUM_ITEMS, 0), False)
+
+    bench("%d new items, %d kept unread" % (NUM_ITEMS, NUM_ITEMS),
+            generate_entries(0, NUM_ITEMS, old_time),
+            generate_entries(NUM_ITEMS, NUM_ITEMS, 0), True)
+
+    bench("%d items, half overlapping" % NUM_ITEMS,
+            generate_entries(0, NUM_ITEMS, old_time),
+            generate_entries(NUM_ITEMS // 2, NUM_ITEMS, 0), True)
+
+    bench("%d old items, nothing fetched" % NUM_ITEMS,
+            generate_entries(0, NUM_ITEMS, old_time), [], False)
@@ -4,7 +4,16 @@
 from base import *
 
 from canto_next.feed import CantoFeed, dict_id, allfeeds
+from canto_next.search import allsearch
 from canto_next.tag import alltags
+from canto_next.storage import CantoShelf, CantoLazyShelf
+from canto_next.hooks import on_hook, unhook_all
+from canto_next.transform import StateFilter
+from canto_next.config import config
+from canto_next.ids import allids
+import canto_next.ids as ids
+import tempfile
+import shutil
 import time
 
 TEST_URL = "http://example.com/"
@@ -33,7 +42,7 @@ class TestFeedIndex(Test):
 
     def compare_tags_and_feeds(self, shelf):
         for tag in alltags.get_tags():
-            for item in alltags.tags[tag]:
+            for item in alltags.get_tag(tag):
                 URL = dict_id(item)["URL"]
                 id = dict_id(item)["ID"]
 
@@ -62,6 +71,7 @@ class TestFeedIndex(Test):
     def generate_baseline(self, feed_name, feed_url, num_items, item_content_template, update_time):
         alltags.reset()
         allfeeds.reset()
+        allsearch.clear()
 
         test_shelf = {}
         test_feed = CantoFeed(test_shelf, feed_name, feed_url, 10, DEF_KEEP_TIME, False)
@@ -74,7 +84,7 @@ class TestFeedIndex(Test):
         if "maintag:Test Feed" not in alltags.tags:
             raise Exception("Failed to populate maintag")
 
-        if len(alltags.tags["maintag:Test Feed"]) != 100:
+        if len(alltags.get_tag("maintag:Test Feed")) != 100:
             raise Exception("Failed to put items in maintag")
 
         if feed_url not in test_shelf:
@@ -131,7 +141,7 @@ class TestFeedIndex(Test):
 
         self.compare_feed_and_tags(test_shelf)
 
-        tag = alltags.tags["maintag:Test Feed"]
+        tag = alltags.get_tag("maintag:Test Feed")
         nitems = len(tag)
 
         if nitems != 105:
@@ -139,6 +149,39 @@ class TestFeedIndex(Test):
         if dict_id(tag[100])["ID"] != "http://example.com/0/":
             raise Exception("Failed to keep order got id = %s" % dict_id(tag[100])["ID"])
 
+        self.banner("search index")
+
+        found = sorted([ dict_id(i)["ID"] for i in allsearch.search("Title 3") ])
+        if found != [ TEST_URL + "3/", TEST_URL + "3/updated" ]:
+            raise Exception("Bad search results: %s" % found)
+
+        found = [ dict_id(i)["ID"] for i in allsearch.search("title 7") ]
+        if found != [ TEST_URL + "7/updated" ]:
+            raise Exception("Discarded item left in search: %s" % found)
+
+        if len(allsearch.search("updated")) != 100:
+            raise Exception("Bad search results: %s" % allsearch.search("updated"))
+
+        self.banner("discarded ids released")
+
+        release_delay = ids.RELEASE_DELAY
+        ids.RELEASE_DELAY = 0
+        try:
+            allids.release([])
+        finally:
+            ids.RELEASE_DELAY = release_delay
+
+        if allids.lookup(TEST_URL, TEST_URL + "7/") != None:
+            raise Exception("Discarded item's id not released")
+        if allids.lookup(TEST_URL, TEST_URL + "7/updated") == None or\
+                allids.lookup(TEST_URL, TEST_URL + "0/") == None:
+            raise Exception("Released id still in use")
+
+        gone = json.dumps({ "URL" : TEST_URL, "ID" : TEST_URL + "7/" })
+        if allids.from_protocol({ gone : [ "title" ] }) != ({}, {}) or\
+                allids.lookup(TEST_URL, TEST_URL + "7/") != None:
+            raise Exception("Looking up a gone item interned it")
+
         self.banner("keep_time")
 
         test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now - 300)
@@ -147,7 +190,7 @@ class TestFeedIndex(Test):
 
         self.compare_feed_and_tags(test_shelf)
 
-        tag = alltags.tags["maintag:Test Feed"]
+        tag = alltags.get_tag("maintag:Test Feed")
         nitems = len(tag)
         if nitems != 200:
             raise Exception("Wrong number of items in tag! %d - %s" % (nitems, tag))
@@ -180,7 +223,7 @@ class TestFeedIndex(Test):
 
         self.compare_feed_and_tags(test_shelf)
 
-        tag = alltags.tags["maintag:Test Feed"]
+        tag = alltags.get_tag("maintag:Test Feed")
         nitems = len(tag)
 
         if nitems != 175:
@@ -192,12 +235,181 @@ class TestFeedIndex(Test):
 
         test_feed.index(self.generate_update_contents(0, update_content, now))
 
-        tag = alltags.tags["maintag:Test Feed"]
+        tag = alltags.get_tag("maintag:Test Feed")
         nitems = len(tag)
 
         if nitems != 100:
             raise Exception("Wrong number of items in tag! %d - %s" % (nitems, tag))
 
+        self.banner("unchanged content doesn't retag")
+
+        changed = []
+        on_hook("daemon_tag_change", lambda tag : changed.append(tag), "test_unchanged")
+
+        test_feed.index(self.generate_update_contents(0, update_content, now))
+        test_feed.index(self.generate_update_contents(100, content, now))
+        if changed:
+            raise Exception("Unchanged index changed tags: %s" % changed)
+
+        second_update = self.generate_update_contents(100, content, now)
+        second_update["entries"][3]["title"] = "Changed"
+        test_feed.index(second_update)
+
+        unhook_all("test_unchanged")
+
+        if changed != [ "maintag:Test Feed" ]:
+            raise Exception("Changed content didn't change tag: %s" % changed)
+
+        found = [ dict_id(i)["ID"] for i in allsearch.search("changed") ]
+        if found != [ TEST_URL + "3/" ]:
+            raise Exception("Changed content not searchable: %s" % found)
+
+        self.banner("unchanged content doesn't retag on lazy shelf")
+
+        # Old entries come back from the lazy shelf stripped of content.
+
+        alltags.reset()
+        allfeeds.reset()
+        allsearch.clear()
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            lazy_shelf = CantoLazyShelf(tmpdir + "/feeds")
+            test_feed = CantoFeed(lazy_shelf, "Test Feed", TEST_URL, 10, DEF_KEEP_TIME, False)
+            test_feed.index(self.generate_update_contents(100, content, now))
+
+            changed = []
+            on_hook("daemon_tag_change", lambda tag : changed.append(tag), "test_unchanged")
+
+            try:
+                test_feed.index(self.generate_update_contents(100, content, now))
+            finally:
+                unhook_all("test_unchanged")
+
+            if changed:
+                raise Exception("Unchanged index changed tags: %s" % changed)
+
+            # Content changes the shelf can't compare still reach search.
+
+            second_update = self.generate_update_contents(100, content, now)
+            second_update["entries"][3]["summary"] = "Summarized"
+            test_feed.index(second_update)
+
+            found = [ dict_id(i)["ID"] for i in allsearch.search("summarized") ]
+            if found != [ TEST_URL + "3/" ]:
+                raise Exception("Changed summary not searchable: %s" % found)
+
+            lazy_shelf.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.banner("kept entries changed in place don't change snapshot")
+
+        alltags.reset()
+        allfeeds.reset()
+        allsearch.clear()
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shelf = CantoShelf(tmpdir + "/feeds")
+            test_feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, DEF_KEEP_TIME, False)
+
+            first_update = self.generate_update_contents(10, content, now)
+            for item in first_update["entries"]:
+                item["canto-state"] = [ "read" ]
+            test_feed.index(first_update)
+
+            # Like an edit_ plugin, while the snapshot is being written.
+
+            def edit_mark(feed, update_contents, tags_to_add, tags_to_remove, remove_items):
+                for item in update_contents["entries"]:
+                    item["canto-state"].append("marked")
+                return (tags_to_add, tags_to_remove, remove_items)
+
+            snap = shelf.snapshot()
+            written = json.dumps(snap, sort_keys=True)
+
+            test_feed.plugin_attrs["edit_mark"] = edit_mark
+            test_feed.index(self.generate_update_contents(5, content, now))
+
+            if json.dumps(snap, sort_keys=True) != written:
+                raise Exception("Snapshot changed by index: %s" % snap[TEST_URL])
+            if shelf[TEST_URL]["entries"][9]["canto-state"] != [ "read", "marked" ]:
+                raise Exception("Lost change to kept entry: %s" % shelf[TEST_URL])
+
+            shelf.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.banner("plugin changing state in place retags")
+
+        alltags.reset()
+        allfeeds.reset()
+        allsearch.clear()
+
+        test_shelf = {}
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10, DEF_KEEP_TIME, False)
+        config.global_transform = None
+        alltags.tag_transform("maintag:Test Feed", StateFilter("read"))
+
+        first_update = self.generate_update_contents(3, content, now)
+        for item in first_update["entries"]:
+            item["canto-state"] = []
+        test_feed.index(first_update)
+
+        if len(alltags.get_tag("maintag:Test Feed")) != 3:
+            raise Exception("Bad tag: %s" % alltags.get_tag("maintag:Test Feed"))
+
+        # Like sync-inoreader, marking the merged items read in place.
+
+        def edit_read(feed, update_contents, tags_to_add, tags_to_remove, remove_items):
+            for item in update_contents["entries"]:
+                if "read" not in item["canto-state"]:
+                    item["canto-state"].append("read")
+            return (tags_to_add, tags_to_remove, remove_items)
+
+        changed = []
+        on_hook("daemon_tag_change", lambda tag : changed.append(tag), "test_unchanged")
+
+        test_feed.plugin_attrs["edit_read"] = edit_read
+        try:
+            test_feed.index(self.generate_update_contents(2, content, now))
+        finally:
+            unhook_all("test_unchanged")
+            del test_feed.plugin_attrs["edit_read"]
+
+        if changed != [ "maintag:Test Feed" ]:
+            raise Exception("State change didn't change tag: %s" % changed)
+        if alltags.get_tag("maintag:Test Feed") != []:
+            raise Exception("Read items left in tag: %s" % alltags.get_tag("maintag:Test Feed"))
+        if alltags.tag_counts("maintag:Test Feed") != { "total" : 0 }:
+            raise Exception("Tag counts disagree: %s" % alltags.tag_counts("maintag:Test Feed"))
+
+        self.banner("get / set attributes")
+
+        test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now)
+
+        a, b = [ test_feed._item_id(e) for e in test_shelf[TEST_URL]["entries"][:2] ]
+        missing = json.dumps({ "URL" : TEST_URL, "ID" : TEST_URL + "missing/" })
+
+        got = test_feed.get_attributes([ a, b, missing ], { a : [ "title", "description" ],
+                b : [ "link" ], missing : [ "link" ] })
+        if got != { a : { "title" : "Title 0", "description" : "" },
+                b : { "link" : TEST_URL + "1/" },
+                missing : { "title" : "???", "link" : "" } }:
+            raise Exception("Bad attributes: %s" % got)
+
+        test_feed.set_attributes([ a ], { a : { "canto-state" : [ "read" ], "title" : "Retitled" } })
+
+        if test_shelf[TEST_URL]["entries"][0]["title"] != "Retitled":
+            raise Exception("Attributes not set: %s" % test_shelf[TEST_URL]["entries"][0])
+        if not alltags.has_state(a, "read") or a not in alltags.get_tag("maintag:Test Feed"):
+            raise Exception("Tags not updated for set attributes")
+
+        found = [ dict_id(i)["ID"] for i in allsearch.search("retitled") ]
+        if found != [ TEST_URL + "0/" ]:
+            raise Exception("Set title not searchable: %s" % found)
+
         return True
 
 TestFeedIndex("feed index")
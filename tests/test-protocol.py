@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.protocol import CantoReadBuffer, FRAME_HEADER, READ_BUFFER, MAX_MESSAGE
+
+class TestProtocol(Test):
+    def frame(self, message):
+        data = message.encode("UTF-8")
+        return FRAME_HEADER.pack(len(data)) + data
+
+    # Feed stream to a buffer, at most chunk bytes per recv, and return the
+    # messages it gives back.
+
+    def read_all(self, stream, chunk):
+        buf = CantoReadBuffer()
+        messages = []
+
+        i = 0
+        while i < len(stream):
+            space = buf.space()
+            n = min(len(space), chunk, len(stream) - i)
+            space[:n] = stream[i:i + n]
+            buf.received(n)
+            i += n
+
+            message = buf.message()
+            while message != None:
+                messages.append(message)
+                message = buf.message()
+
+        return messages
+
+    def check(self):
+        messages = [ json.dumps(("PING", [])),
+                json.dumps(("ITEMS", [ "maintag:Ünïcode" ])),
+                json.dumps(("SETATTRIBUTES", "x" * (READ_BUFFER * 2))),
+                json.dumps(("PING", [])) ] * 3
+
+        stream = b"".join([ self.frame(m) for m in messages ])
+
+        for chunk in [ 7, 1000, 4096, READ_BUFFER, len(stream) ]:
+            got = self.read_all(stream, chunk)
+            if got != messages:
+                raise Exception("Bad messages reading %d bytes at a time" % chunk)
+
+        # A header claiming a huge (or negative) message is a hangup, and
+        # doesn't get a buffer that size.
+
+        for size in [ MAX_MESSAGE + 1, 2 ** 62, -1 ]:
+            buf = CantoReadBuffer()
+            header = FRAME_HEADER.pack(size)
+            buf.space()[:len(header)] = header
+            buf.received(len(header))
+
+            if buf.message() != "":
+                raise Exception("Accepted message size %d" % size)
+            if len(buf.space()) > READ_BUFFER:
+                raise Exception("Grew buffer for message size %d" % size)
+
+        return True
+
+TestProtocol("protocol")
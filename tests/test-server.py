@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.server import CantoServer
+from canto_next.protocol import CantoReadBuffer, FRAME_HEADER, MAX_MESSAGE
+import canto_next.server as server
+
+from threading import Event
+import tempfile
+import asyncio
+import socket
+import shutil
+import select
+import time
+
+# The server's end of a connection, recording what it's asked to send and
+# how much actually went.
+
+class RecordingSocket(socket.socket):
+    def __init__(self, *args, **kwargs):
+        socket.socket.__init__(self, *args, **kwargs)
+        self.sends = []
+
+    def sendmsg(self, bufs, *args):
+        sent = socket.socket.sendmsg(self, bufs, *args)
+        self.sends.append((len(bufs), sum([ len(b) for b in bufs ]), sent))
+        return sent
+
+class TestServer(Test):
+    def frame(self, cmd, args):
+        data = json.dumps((cmd, args)).encode("UTF-8")
+        return FRAME_HEADER.pack(len(data)) + data
+
+    # Read up to n messages from sock, stopping early if it's closed.
+
+    def read_messages(self, sock, n):
+        buf = CantoReadBuffer()
+        messages = []
+
+        while len(messages) < n:
+            message = buf.message()
+            if message != None:
+                messages.append(tuple(json.loads(message)))
+                continue
+
+            got = sock.recv_into(buf.space())
+            if not got:
+                break
+            buf.received(got)
+
+        return messages
+
+    # Have the server serve one end of a socketpair, and return both ends,
+    # once the server's ready to write to it. If bufsize is given, both ends'
+    # kernel buffers are shrunk to about that.
+
+    def connect(self, bufsize=None):
+        ours, theirs = socket.socketpair()
+        theirs = RecordingSocket(fileno = theirs.detach())
+
+        if bufsize:
+            ours.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, bufsize)
+            theirs.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, bufsize)
+
+        theirs.setblocking(False)
+        ours.settimeout(10)
+
+        asyncio.run_coroutine_threadsafe(self.server.serve(theirs),
+                self.server.loop)
+
+        while theirs not in self.server.write_queues:
+            time.sleep(0.01)
+
+        return ours, theirs
+
+    # Hold up the event loop until the returned Event is set.
+
+    def block_loop(self):
+        blocked = Event()
+        release = Event()
+
+        def block():
+            blocked.set()
+            release.wait()
+
+        self.server.loop.call_soon_threadsafe(block)
+        blocked.wait()
+        return release
+
+    # Echo every command back. SLOW commands take long enough that, if
+    # commands from a connection were run in parallel, replies to later
+    # commands would overtake them.
+
+    def dispatch(self, conn, d):
+        cmd, args = d
+        if cmd == "SLOW":
+            time.sleep(0.05)
+        self.server.write(conn, cmd, args)
+
+    def check_order(self):
+        self.banner("replies in order")
+
+        ours, theirs = self.connect()
+
+        commands = []
+        for i in range(20):
+            if i % 3 == 0:
+                commands.append(("SLOW", i))
+            else:
+                commands.append(("FAST", i))
+
+        ours.sendall(b"".join([ self.frame(c, a) for c, a in commands ]))
+
+        got = self.read_messages(ours, len(commands))
+        if got != commands:
+            raise Exception("Replies out of order: %s" % got)
+
+        ours.close()
+
+    def check_bad_frame(self):
+        self.banner("bad frame drops connection")
+
+        ours, theirs = self.connect()
+        ours.sendall(FRAME_HEADER.pack(MAX_MESSAGE + 1) + b"{}")
+
+        if ours.recv(1) != b"":
+            raise Exception("Connection not dropped")
+
+        ours.close()
+
+    def check_coalesce(self):
+        self.banner("writes coalesced")
+
+        ours, theirs = self.connect()
+
+        # Everything written while the loop is busy goes out in one send.
+
+        release = self.block_loop()
+        for i in range(5):
+            self.server.write(theirs, "WRITE", i)
+        release.set()
+
+        got = self.read_messages(ours, 5)
+        if got != [ ("WRITE", i) for i in range(5) ]:
+            raise Exception("Bad messages: %s" % got)
+
+        if len(theirs.sends) != 1 or theirs.sends[0][0] != 10:
+            raise Exception("Writes not coalesced: %s" % theirs.sends)
+
+        ours.close()
+
+    def check_partial(self):
+        self.banner("partial sends resumed")
+
+        ours, theirs = self.connect(4096)
+
+        big = "x" * (1024 * 1024)
+        self.server.write(theirs, "BIG", big)
+        self.server.write(theirs, "AFTER", [])
+
+        got = self.read_messages(ours, 2)
+        if got != [ ("BIG", big), ("AFTER", []) ]:
+            raise Exception("Bad messages after partial sends")
+
+        partial = [ s for s in theirs.sends if s[2] < s[1] ]
+        if not partial:
+            raise Exception("No partial sends: %s" % theirs.sends)
+
+        ours.close()
+
+    def check_overflow(self):
+        self.banner("unread connection dropped")
+
+        ours, theirs = self.connect(4096)
+
+        max_queued = server.MAX_QUEUED
+        server.MAX_QUEUED = 64 * 1024
+        try:
+            # Never read, so everything queues.
+
+            r = None
+            for i in range(100):
+                r = self.server.write(theirs, "FILL", "x" * 10000)
+                if r == select.POLLHUP:
+                    break
+        finally:
+            server.MAX_QUEUED = max_queued
+
+        if r != select.POLLHUP:
+            raise Exception("Connection not dropped after %d writes" % i)
+
+        if self.server.write(theirs, "MORE", []) != select.POLLHUP:
+            raise Exception("Wrote to dropped connection")
+
+        # Whatever made it out before the drop, then hangup.
+        while ours.recv(65536):
+            pass
+
+        ours.close()
+
+    def check(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.server = CantoServer(tmpdir + "/socket", self.dispatch)
+            try:
+                self.check_order()
+                self.check_bad_frame()
+                self.check_coalesce()
+                self.check_partial()
+                self.check_overflow()
+            finally:
+                self.server.exit()
+
+            if not self.server.loop.is_closed():
+                raise Exception("Event loop left open")
+        finally:
+            shutil.rmtree(tmpdir)
+
+        return True
+
+TestServer("server")
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.storage import CantoShelf, CantoJournalShelf, CantoShardedShelf, CantoLazyShelf, CantoSQLShelf, CantoSyncScheduler
+import canto_next.storage as storage
+
+from threading import Thread, Lock
+import tempfile
+import json
+import gzip
+import time
+import shutil
+import os
+
+TEST_URL = "http://example.com/"
+
+class TestStorage(Test):
+    def generate_feed(self, num_items, title="Title %d"):
+        entries = []
+        for i in range(num_items):
+            entries.append({ "id" : TEST_URL + "%d/" % i, "title" : title % i })
+        return { "entries" : entries }
+
+    # Sync and wait for the writer to finish.
+
+    def flush(self, shelf):
+        shelf.sync()
+        shelf.wait_writer()
+        shelf.wait_writer()
+
+    def check_feed(self, shelf, num_items, title="Title %d"):
+        if TEST_URL not in shelf:
+            raise Exception("Feed missing from shelf")
+        if shelf[TEST_URL] != self.generate_feed(num_items, title):
+            raise Exception("Feed content mismatch: %s" % shelf[TEST_URL])
+
+    def check_journal(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("journal round trip")
+
+        shelf = CantoJournalShelf(fname)
+        shelf[TEST_URL] = self.generate_feed(10)
+        shelf["other"] = self.generate_feed(1)
+        self.flush(shelf)
+
+        if not os.path.exists(shelf.journal_name):
+            raise Exception("Sync didn't write journal")
+
+        # Nothing dirty, shouldn't grow.
+        size = shelf.journal_size()
+        self.flush(shelf)
+        if shelf.journal_size() != size:
+            raise Exception("Clean sync wrote to journal")
+
+        shelf[TEST_URL] = self.generate_feed(20, "New %d")
+        del shelf["other"]
+        self.flush(shelf)
+
+        # Simulate dying mid-record.
+        f = open(shelf.journal_name, "a")
+        f.write('["set", "partial", {')
+        f.close()
+
+        reopened = CantoJournalShelf(fname)
+        self.check_feed(reopened, 20, "New %d")
+        if "other" in reopened or "partial" in reopened:
+            raise Exception("Replayed deleted or partial key")
+
+        # Records journaled after the crash mustn't be lost behind it.
+        reopened["after"] = self.generate_feed(2)
+        self.flush(reopened)
+
+        again = CantoJournalShelf(fname)
+        if "after" not in again or len(again["after"]["entries"]) != 2:
+            raise Exception("Lost record journaled after partial record")
+        self.check_feed(again, 20, "New %d")
+
+        self.banner("journal compaction")
+
+        # Force compaction on next sync.
+
+        min_compact = storage.JOURNAL_MIN_COMPACT
+        storage.JOURNAL_MIN_COMPACT = 0
+        try:
+            reopened["other"] = self.generate_feed(1)
+            self.flush(reopened)
+        finally:
+            storage.JOURNAL_MIN_COMPACT = min_compact
+
+        if os.path.exists(reopened.journal_name) or\
+                os.path.exists(reopened.old_journal_name):
+            raise Exception("Compaction left journal behind")
+
+        # Snapshot alone should now have everything.
+        plain = CantoShelf(fname)
+        self.check_feed(plain, 20, "New %d")
+        if "other" not in plain:
+            raise Exception("Compaction missed unjournaled key")
+
+        reopened[TEST_URL] = self.generate_feed(5)
+        reopened.close()
+
+        plain = CantoShelf(fname)
+        self.check_feed(plain, 5)
+
+    def check_snapshot(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("copy-on-write snapshot")
+
+        shelf = CantoShelf(fname)
+        shelf[TEST_URL] = self.generate_feed(10)
+
+        snap = shelf.snapshot()
+        shelf.set_entry_attributes(TEST_URL,
+                { TEST_URL + "0/" : { "title" : "Changed" } })
+        shelf.update_umod()
+
+        if snap[TEST_URL] != self.generate_feed(10):
+            raise Exception("Snapshot changed under us: %s" % snap[TEST_URL])
+        if snap["control"] is shelf["control"]:
+            raise Exception("Control data not copied on write")
+        if shelf[TEST_URL]["entries"][0]["title"] != "Changed":
+            raise Exception("Change lost")
+
+        # Lists in entries are appended to in place.
+
+        shelf.set_entry_attributes(TEST_URL,
+                { TEST_URL + "1/" : { "canto-state" : [ "read" ] } })
+        snap = shelf.snapshot()
+        shelf.unshare(TEST_URL)
+        shelf[TEST_URL]["entries"][1]["canto-state"].append("marked")
+
+        if snap[TEST_URL]["entries"][1]["canto-state"] != [ "read" ]:
+            raise Exception("Snapshot state changed under us: %s" % snap[TEST_URL])
+
+        # Lookups must find the copies, not the snapshot's entries.
+
+        got = shelf.get_entries(TEST_URL, [ TEST_URL + "0/", "missing" ])
+        if list(got.keys()) != [ TEST_URL + "0/" ] or\
+                got[TEST_URL + "0/"] is not shelf[TEST_URL]["entries"][0]:
+            raise Exception("Stale entry index: %s" % got)
+
+        shelf.close()
+
+        shelf = CantoShelf(fname)
+        if shelf[TEST_URL]["entries"][0]["title"] != "Changed":
+            raise Exception("Change not written: %s" % shelf[TEST_URL])
+
+    def check_concurrent(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("concurrent syncs")
+
+        shelf = CantoShelf(fname)
+
+        # Slow writes down, so syncs pile up behind them.
+
+        lock = Lock()
+        writing = []
+        written = []
+        overlapped = []
+        write_snapshot = shelf.write_snapshot
+
+        def slow_write(snap):
+            lock.acquire()
+            if writing:
+                overlapped.append(snap["control"]["canto-generation"])
+            writing.append(True)
+            lock.release()
+
+            time.sleep(0.05)
+            write_snapshot(snap)
+            written.append(snap["control"]["canto-generation"])
+
+            lock.acquire()
+            writing.pop()
+            lock.release()
+
+        shelf.write_snapshot = slow_write
+
+        def syncs(n):
+            for i in range(5):
+                shelf[TEST_URL] = self.generate_feed(n * 10 + i)
+                shelf.sync()
+
+        threads = [ Thread(target = syncs, args = (n,)) for n in range(1, 4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        shelf.wait_writer()
+
+        if overlapped:
+            raise Exception("Writers overlapped: %s" % overlapped)
+        if written != sorted(written):
+            raise Exception("Syncs landed out of order: %s" % written)
+        if shelf.shared:
+            raise Exception("Finished snapshot still shared: %s" % shelf.shared)
+
+        # A failed write is tried again by the next sync.
+
+        def bad_write(snap):
+            raise Exception("Disk full")
+
+        shelf.write_snapshot = bad_write
+        shelf[TEST_URL] = self.generate_feed(7)
+        self.flush(shelf)
+
+        shelf.write_snapshot = write_snapshot
+        self.flush(shelf)
+
+        if shelf.dirty:
+            raise Exception("Retry left dirty keys: %s" % shelf.dirty)
+
+        reopened = CantoShelf(fname)
+        self.check_feed(reopened, 7)
+        reopened.close()
+
+        shelf.close()
+
+    def check_scheduler(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("sync scheduler")
+
+        shelf = CantoShelf(fname)
+        sched = CantoSyncScheduler(shelf)
+
+        now = time.time()
+        if sched.needs_sync(now):
+            raise Exception("Clean shelf needs sync?")
+
+        shelf[TEST_URL] = self.generate_feed(10)
+        now = shelf.last_change
+
+        if sched.needs_sync(now + 1):
+            raise Exception("Didn't debounce")
+        if not sched.needs_sync(now + storage.SYNC_DEBOUNCE):
+            raise Exception("Didn't sync after debounce")
+
+        # Constant changes still sync after max latency.
+        shelf.dirty_since = now - storage.SYNC_MAX_LATENCY
+        if not sched.needs_sync(now + 1):
+            raise Exception("Didn't sync after max latency")
+
+        sched.sync()
+
+        if shelf.dirty_since or sched.stats()["syncs"] != 1:
+            raise Exception("Sync not recorded: %s" % sched.stats())
+
+        shelf.update_umod()
+        if sched.needs_sync(time.time() + storage.SYNC_DEBOUNCE):
+            raise Exception("Didn't respect min interval")
+
+        shelf.close()
+
+        shelf = CantoShelf(fname)
+        self.check_feed(shelf, 10)
+
+    def check_sharded(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("shard migration")
+
+        shelf = CantoShelf(fname)
+        shelf[TEST_URL] = self.generate_feed(10)
+        shelf["other"] = self.generate_feed(1)
+        shelf.close()
+
+        shelf = CantoShardedShelf(fname)
+        self.check_feed(shelf, 10)
+        self.flush(shelf)
+
+        if len(os.listdir(shelf.shard_dir)) != 3:
+            raise Exception("Wrong number of shards: %s" % os.listdir(shelf.shard_dir))
+
+        self.banner("shard dirty tracking")
+
+        other_shard = shelf.shard_name("other")
+        mtime = os.stat(other_shard).st_mtime_ns
+
+        shelf[TEST_URL] = self.generate_feed(20, "New %d")
+        self.flush(shelf)
+
+        if os.stat(other_shard).st_mtime_ns != mtime:
+            raise Exception("Untouched shard was rewritten")
+
+        del shelf["other"]
+        shelf.close()
+
+        if os.path.exists(other_shard):
+            raise Exception("Deleted key's shard still exists")
+
+        shelf = CantoShardedShelf(fname)
+        self.check_feed(shelf, 20, "New %d")
+        if "other" in shelf:
+            raise Exception("Deleted key came back")
+
+        self.banner("shard export")
+
+        shelf.set_entry_attributes(TEST_URL,
+                { TEST_URL + "1/" : { "canto-state" : [ "read" ] } })
+        self.flush(shelf)
+        shelf.sync(True)
+        shelf.wait_writer()
+
+        plain = CantoShelf(fname)
+        if plain[TEST_URL]["entries"][1].get("canto-state") != [ "read" ] or\
+                "other" in plain:
+            raise Exception("Bad export: %s" % plain[TEST_URL])
+        shelf.close()
+
+        self.banner("shard import")
+
+        # Replace the feeds file like sync-rsync, with an older mtime.
+
+        remote = CantoShelf(tmpdir + "/remote")
+        remote[TEST_URL] = self.generate_feed(5, "Remote %d")
+        remote.close()
+
+        mtime = os.stat(fname).st_mtime - 60
+        shutil.move(tmpdir + "/remote", fname)
+        os.utime(fname, (mtime, mtime))
+
+        shelf = CantoShardedShelf(fname)
+        self.check_feed(shelf, 5, "Remote %d")
+        shelf[TEST_URL] = self.generate_feed(6, "Remote %d")
+        shelf.close()
+
+        shelf = CantoShardedShelf(fname)
+        self.check_feed(shelf, 6, "Remote %d")
+
+    def check_state(self, tmpdir):
+        fname = tmpdir + "/feeds"
+        read = { TEST_URL + "1/" : { "canto-state" : [ "read" ] } }
+
+        for shelf_type in [ CantoShelf, CantoJournalShelf, CantoShardedShelf ]:
+            self.banner("%s hot state" % shelf_type.__name__)
+
+            shelf = shelf_type(fname)
+            shelf[TEST_URL] = self.generate_feed(10)
+            self.flush(shelf)
+
+            if shelf_type == CantoShardedShelf:
+                content = shelf.shard_name(TEST_URL)
+            else:
+                content = fname
+            mtime = os.stat(content).st_mtime_ns
+
+            shelf.set_entry_attributes(TEST_URL, read)
+            self.flush(shelf)
+
+            if os.stat(content).st_mtime_ns != mtime:
+                raise Exception("State change rewrote content")
+
+            # Content change after a journaled state change.
+
+            shelf.set_entry_attributes(TEST_URL,
+                    { TEST_URL + "1/" : { "title" : "Changed" } })
+            self.flush(shelf)
+            shelf.set_entry_attributes(TEST_URL,
+                    { TEST_URL + "1/" : { "canto-state" : [] } })
+            self.flush(shelf)
+
+            # Reopen without closing, like a crash.
+
+            reopened = shelf_type(fname)
+            entry = reopened[TEST_URL]["entries"][1]
+            if entry["canto-state"] != [] or entry["title"] != "Changed":
+                raise Exception("Bad state after replay: %s" % entry)
+
+            # Die mid-record, then journal more state on top.
+
+            f = open(reopened.state_name, "a")
+            f.write('["state", 1000, "' + TEST_URL + '", ')
+            f.close()
+
+            crashed = shelf_type(fname)
+            crashed.set_entry_attributes(TEST_URL, read)
+            self.flush(crashed)
+
+            if not os.path.exists(crashed.state_name):
+                raise Exception("State change wasn't journaled")
+
+            reopened = shelf_type(fname)
+            entry = reopened[TEST_URL]["entries"][1]
+            if entry["canto-state"] != [ "read" ]:
+                raise Exception("Lost state journaled after partial record")
+            reopened.close()
+
+            shutil.rmtree(tmpdir)
+            os.makedirs(tmpdir)
+
+    def check_stream(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("streaming load")
+
+        shelf = CantoShelf(fname)
+        for i in range(20):
+            shelf[TEST_URL + str(i)] = self.generate_feed(i)
+        shelf[TEST_URL] = self.generate_feed(10)
+        shelf.set_entry_attributes(TEST_URL,
+                { TEST_URL + "1/" : { "title" : "Changed" } })
+        self.flush(shelf)
+        shelf.set_entry_attributes(TEST_URL,
+                { TEST_URL + "1/" : { "canto-state" : [ "read" ] } })
+        self.flush(shelf)
+
+        if not os.path.exists(shelf.state_name):
+            raise Exception("State change not journaled")
+
+        # Make sure values get split across reads.
+
+        load_chunk = storage.LOAD_CHUNK
+        storage.LOAD_CHUNK = 7
+        try:
+            shelf = CantoShelf(fname)
+            entry = shelf[TEST_URL]["entries"][1]
+            shelf.wait_loaded()
+        finally:
+            storage.LOAD_CHUNK = load_chunk
+
+        if entry["title"] != "Changed" or entry["canto-state"] != [ "read" ]:
+            raise Exception("Bad streamed entry: %s" % entry)
+        for i in range(20):
+            if shelf[TEST_URL + str(i)] != self.generate_feed(i):
+                raise Exception("Bad streamed feed: %s" % shelf[TEST_URL + str(i)])
+        if "missing" in shelf:
+            raise Exception("Found missing key")
+        shelf.close()
+
+        # Old, single line files load too.
+
+        old = CantoShelf(fname)
+        old.wait_loaded()
+        cache = old.cache
+        old.close()
+
+        fp = gzip.open(fname, "wt", 9, "UTF-8")
+        json.dump(cache, fp)
+        fp.close()
+
+        shelf = CantoShelf(fname)
+        shelf.wait_loaded()
+        if shelf.cache != cache:
+            raise Exception("Failed to load old format")
+        shelf.close()
+
+        self.banner("control data loaded last")
+
+        control = cache.pop("control")
+        control["canto-user-modified"] = 1234
+        cache["control"] = control
+
+        fp = gzip.open(fname, "wt", 9, "UTF-8")
+        json.dump(cache, fp)
+        fp.close()
+
+        storage.LOAD_CHUNK = 7
+        try:
+            shelf = CantoShelf(fname)
+            got = shelf["control"]["canto-user-modified"]
+        finally:
+            storage.LOAD_CHUNK = load_chunk
+
+        if got != 1234:
+            raise Exception("Got placeholder control data: %s" % shelf["control"])
+        shelf.close()
+
+    def check_lazy(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("lazy content")
+
+        feed = self.generate_feed(10)
+        for i, entry in enumerate(feed["entries"]):
+            entry["summary"] = "Summary %d" % i
+
+        shelf = CantoShelf(fname)
+        shelf[TEST_URL] = feed
+        shelf.close()
+
+        shelf = CantoLazyShelf(fname)
+        self.flush(shelf)
+        shelf.close()
+
+        shelf = CantoLazyShelf(fname)
+        if "summary" in shelf[TEST_URL]["entries"][3]:
+            raise Exception("Content resident: %s" % shelf[TEST_URL]["entries"][3])
+
+        id = TEST_URL + "3/"
+        got = shelf.get_entries(TEST_URL, [ id ], [ "title" ])
+        if "summary" in got[id]:
+            raise Exception("Paged in content for metadata")
+
+        shelf.set_entry_attributes(TEST_URL, { id : { "canto-state" : [ "read" ] } })
+        got = shelf.get_entries(TEST_URL, [ id ], [ "summary" ])
+        if got[id]["summary"] != "Summary 3" or got[id]["canto-state"] != [ "read" ]:
+            raise Exception("Bad paged entry: %s" % got[id])
+
+        # Keep old (stripped) entries alongside new content, like index().
+
+        new = shelf[TEST_URL].copy()
+        new["entries"] = [ { "id" : "new", "title" : "New", "summary" : "New" } ] +\
+                new["entries"]
+        shelf[TEST_URL] = new
+        self.flush(shelf)
+        shelf.close()
+
+        shelf = CantoShardedShelf(fname)
+        entries = shelf[TEST_URL]["entries"]
+        if entries[0]["summary"] != "New" or entries[4]["summary"] != "Summary 3" or\
+                entries[4]["canto-state"] != [ "read" ]:
+            raise Exception("Lost content on write: %s" % entries)
+        shelf.close()
+
+        self.banner("lazy export / import")
+
+        shelf = CantoLazyShelf(fname)
+        shelf.set_entry_attributes(TEST_URL, { id : { "canto-state" : [] } })
+        shelf.close()
+
+        plain = CantoShelf(fname)
+        entries = plain[TEST_URL]["entries"]
+        if entries[0]["summary"] != "New" or entries[4]["summary"] != "Summary 3" or\
+                entries[4]["canto-state"] != []:
+            raise Exception("Bad export: %s" % entries)
+
+        remote = CantoShelf(tmpdir + "/remote")
+        remote[TEST_URL] = feed
+        remote.close()
+        shutil.move(tmpdir + "/remote", fname)
+
+        shelf = CantoLazyShelf(fname)
+        if len(shelf[TEST_URL]["entries"]) != 10 or\
+                "summary" in shelf[TEST_URL]["entries"][3]:
+            raise Exception("Bad import: %s" % shelf[TEST_URL]["entries"])
+
+        got = shelf.get_entries(TEST_URL, [ id ], [ "summary" ])
+        if got[id]["summary"] != "Summary 3":
+            raise Exception("Lost imported content: %s" % got[id])
+
+    def check_sqlite(self, tmpdir):
+        fname = tmpdir + "/feeds"
+
+        self.banner("sqlite migration")
+
+        shelf = CantoShelf(fname)
+        shelf[TEST_URL] = self.generate_feed(10)
+        self.flush(shelf)
+
+        # Left in the state journal, as if we'd died.
+
+        shelf.set_entry_attributes(TEST_URL,
+                { TEST_URL + "5/" : { "canto-state" : [ "marked" ] } })
+        shelf.update_umod()
+        self.flush(shelf)
+        if not os.path.exists(shelf.state_name):
+            raise Exception("State not journaled")
+
+        shelf = CantoSQLShelf(fname)
+        if [ e["title"] for e in shelf[TEST_URL]["entries"] ] !=\
+                [ "Title %d" % i for i in range(10) ] or\
+                shelf[TEST_URL]["entries"][5].get("canto-state") != [ "marked" ]:
+            raise Exception("Bad migration: %s" % shelf[TEST_URL])
+        if os.path.exists(shelf.state_name):
+            raise Exception("State journal left after migration")
+
+        self.banner("sqlite entries")
+
+        ids = [ TEST_URL + "3/", TEST_URL + "7/", "missing" ]
+        got = shelf.get_entries(TEST_URL, ids)
+        if sorted(got.keys()) != ids[:2] or got[ids[0]]["title"] != "Title 3":
+            raise Exception("Bad get_entries: %s" % got)
+
+        updated = shelf.set_entry_attributes(TEST_URL,
+                { ids[0] : { "canto-state" : [ "read" ] } })
+        if len(updated) != 1 or updated[0]["canto-state"] != [ "read" ]:
+            raise Exception("Bad set_entry_attributes: %s" % updated)
+
+        shelf[TEST_URL + "2"] = self.generate_feed(2)
+        shelf.close()
+
+        shelf = CantoSQLShelf(fname)
+        entries = shelf[TEST_URL]["entries"]
+        if [ e["id"] for e in entries ] != [ TEST_URL + "%d/" % i for i in range(10) ]:
+            raise Exception("Lost entry order: %s" % entries)
+        if entries[3]["canto-state"] != [ "read" ]:
+            raise Exception("Lost attribute change: %s" % entries[3])
+        if TEST_URL + "2" not in shelf or "control" not in shelf:
+            raise Exception("Lost keys")
+
+        del shelf[TEST_URL + "2"]
+        if TEST_URL + "2" in shelf:
+            raise Exception("Failed to delete key")
+        shelf.close()
+
+        self.banner("sqlite export / import")
+
+        plain = CantoShelf(fname)
+        if plain[TEST_URL]["entries"][3].get("canto-state") != [ "read" ] or\
+                plain[TEST_URL]["entries"][5].get("canto-state") != [ "marked" ] or\
+                TEST_URL + "2" in plain:
+            raise Exception("Bad export: %s" % plain[TEST_URL])
+
+        remote = CantoShelf(tmpdir + "/remote")
+        remote[TEST_URL] = self.generate_feed(5, "Remote %d")
+        remote.close()
+
+        mtime = os.stat(fname).st_mtime - 60
+        shutil.move(tmpdir + "/remote", fname)
+        os.utime(fname, (mtime, mtime))
+
+        shelf = CantoSQLShelf(fname)
+        self.check_feed(shelf, 5, "Remote %d")
+        shelf.close()
+
+    def check(self):
+        for test in [ self.check_snapshot, self.check_concurrent, self.check_scheduler, self.check_journal, self.check_sharded, self.check_state, self.check_stream, self.check_lazy, self.check_sqlite ]:
+            tmpdir = tempfile.mkdtemp()
+            try:
+                test(tmpdir)
+            finally:
+                shutil.rmtree(tmpdir)
+        return True
+
+TestStorage("storage")
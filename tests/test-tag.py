@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.tag import CantoTags
+from canto_next.ids import allids
+from canto_next.config import config
+
+import tempfile
+import shutil
+
+class TestTag(Test):
+    def check_save(self, tmpdir):
+        path = tmpdir + "/tags"
+
+        self.banner("tag save / load")
+
+        a = allids.intern("http://example.com/", "a")
+        b = allids.intern("http://example.com/", "b")
+        c = allids.intern("http://example.org/", "c")
+
+        tags = CantoTags()
+        tags.update_tag("maintag:Test", [], [ a, c, b ])
+        tags.update_tag("user:x", [], [ b ])
+        tags.set_item_states(b, [ "read" ])
+        tags.save(path, { "modified" : 1 })
+
+        loaded = CantoTags()
+        if loaded.load(path, { "modified" : 2 }):
+            raise Exception("Loaded tags with stale stamp")
+        if loaded.tags != {}:
+            raise Exception("Stale tags leaked: %s" % loaded.tags)
+
+        if not loaded.load(path, { "modified" : 1 }):
+            raise Exception("Failed to load tags")
+        if loaded.tags != tags.tags:
+            raise Exception("Bad loaded tags: %s" % loaded.tags)
+        if loaded.get_tag("maintag:Test") != [ a, c, b ]:
+            raise Exception("Bad loaded order: %s" % loaded.get_tag("maintag:Test"))
+        if loaded.items_to_tags([ b ]) != [ "maintag:Test", "user:x" ]:
+            raise Exception("Bad loaded item tags: %s" % loaded.items_to_tags([ b ]))
+        if loaded.tag_counts("maintag:Test") != { "total" : 3, "read" : 1 }:
+            raise Exception("Bad loaded counts: %s" % loaded.tag_counts("maintag:Test"))
+
+        self.banner("tag completeness")
+
+        feeds = [ "http://example.com/", "http://example.org/" ]
+
+        if tags.complete(feeds):
+            raise Exception("Tags complete without indexing feeds")
+        if not loaded.complete(feeds):
+            raise Exception("Loaded tags incomplete")
+
+        # Thrown away, they're complete again once every feed is indexed.
+
+        loaded.reset()
+        if loaded.complete(feeds):
+            raise Exception("Reset tags still complete")
+
+        loaded.feed_members["http://example.com/"] = {}
+        if loaded.complete(feeds):
+            raise Exception("Tags complete with a feed left to index")
+
+        loaded.feed_members["http://example.org/"] = {}
+        if not loaded.complete(feeds):
+            raise Exception("Tags incomplete with every feed indexed")
+
+    def check_states(self):
+        self.banner("state counts")
+
+        a = allids.intern("http://example.com/", "a")
+        b = allids.intern("http://example.com/", "b")
+
+        tags = CantoTags()
+        tags.set_item_states(a, [ "read" ])
+        tags.add_tag(a, "maintag:Test")
+        tags.add_tag(b, "maintag:Test")
+        tags.add_tag(b, "user:x")
+
+        tags.set_item_states(b, [ "read", "marked" ])
+        if tags.tag_counts("maintag:Test") != { "total" : 2, "read" : 2, "marked" : 1 }:
+            raise Exception("Bad counts: %s" % tags.tag_counts("maintag:Test"))
+
+        tags.set_item_states(a, [])
+        tags.remove_id(b)
+        if tags.tag_counts("maintag:Test") != { "total" : 1 } or\
+                tags.tag_counts("user:x") != { "total" : 0 }:
+            raise Exception("Bad counts after removal: %s / %s" %\
+                    (tags.tag_counts("maintag:Test"), tags.tag_counts("user:x")))
+
+        if not tags.has_state(b, "marked") or tags.has_state(a, "read"):
+            raise Exception("Bad item states")
+
+    def check_membership(self):
+        self.banner("tag membership")
+
+        a = allids.intern("http://example.com/", "a")
+        b = allids.intern("http://example.com/", "b")
+        c = allids.intern("http://example.com/", "c")
+
+        tags = CantoTags()
+        tags.add_tag(a, "maintag:Test")
+        tags.add_tag(b, "maintag:Test")
+        tags.add_tag(c, "maintag:Test")
+        tags.add_tag(b, "user:x")
+
+        tags.update_tag("maintag:Test", [ a ], [ a ])
+        if tags.get_tag("maintag:Test") != [ b, c, a ]:
+            raise Exception("Bad update order: %s" % tags.get_tag("maintag:Test"))
+
+        tags.remove_tag(b, "maintag:Test")
+        if tags.items_to_tags([ b ]) != [ "user:x" ]:
+            raise Exception("Bad tags after remove: %s" % tags.items_to_tags([ b ]))
+
+        tags.remove_id(b)
+        if tags.items_to_tags([ b ]) != [] or tags.get_tag("user:x") != []:
+            raise Exception("Item left in tags after remove_id")
+
+        # Transforms filtering items out of a tag take them out of the index
+        config.global_transform = None
+        tags.changed_tags = [ "maintag:Test" ]
+        tags.tag_transforms["maintag:Test"] = lambda tag, attrs: [ id for id in tag if id != c ]
+        tags.do_tag_changes()
+
+        if tags.items_to_tags([ a, c ]) != [ "maintag:Test" ] or\
+                tags.items_to_tags([ c ]) != []:
+            raise Exception("Index out of sync with transformed tag")
+
+    def check_incremental(self):
+        self.banner("incremental filtering")
+
+        ids = [ allids.intern("http://example.com/", "%d" % i) for i in range(10) ]
+
+        # Filter out odd items, remembering what we were asked to filter.
+
+        class OddFilter():
+            def __init__(self):
+                self.seen = []
+
+            def incremental(self):
+                return True
+
+            def __call__(self, tag, attrs):
+                self.seen.extend(tag)
+                return [ id for id in tag if ids.index(id) % 2 == 0 ]
+
+        config.global_transform = None
+        odd = OddFilter()
+
+        tags = CantoTags()
+        tags.tag_transform("maintag:Test", odd)
+        tags.update_tag("maintag:Test", [], ids[:6])
+        tags.do_tag_changes()
+
+        if tags.get_tag("maintag:Test") != [ ids[0], ids[2], ids[4] ]:
+            raise Exception("Bad filtered tag: %s" % tags.get_tag("maintag:Test"))
+
+        odd.seen = []
+        tags.add_tag(ids[6], "maintag:Test")
+        tags.add_tag(ids[7], "maintag:Test")
+        tags.update_tag("maintag:Test", [ ids[0] ], [ ids[0] ])
+        tags.do_tag_changes()
+
+        if odd.seen != [ ids[6], ids[7], ids[0] ]:
+            raise Exception("Filtered more than the dirty items: %s" % odd.seen)
+
+        if tags.get_tag("maintag:Test") != [ ids[2], ids[4], ids[6], ids[0] ]:
+            raise Exception("Bad incremental tag: %s" % tags.get_tag("maintag:Test"))
+        if tags.items_to_tags([ ids[7] ]) != []:
+            raise Exception("Filtered item left in index")
+
+    def check(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.check_save(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.check_membership()
+        self.check_states()
+        self.check_incremental()
+        return True
+
+TestTag("tag")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.transform import eval_transform, is_filter, SortTransform
+from canto_next.hooks import call_hook
+from canto_next.search import allsearch
+from canto_next.tag import alltags
+from canto_next.ids import allids
+
+from threading import Thread
+import sys
+import canto_next.transform as transform
+
+class TestTransform(Test):
+    def setup(self):
+        self.items = list(range(10))
+        self.attrs = {}
+        for i in self.items:
+            self.attrs[i] = { "title" : "Title %d" % (9 - i),
+                    "canto-state" : [ "read" ] if i % 2 else [] }
+
+        # StateFilter asks alltags.
+        alltags.clear_tags()
+        for i in self.items:
+            alltags.set_item_states(i, self.attrs[i]["canto-state"])
+
+    def check_transform(self, transform, expected):
+        got = eval_transform(transform).transform(self.items[:], self.attrs)
+        if got != expected:
+            raise Exception("%s - expected %s got %s" % (transform, expected, got))
+
+    def check_fused(self):
+        self.banner("fused All / Any")
+
+        self.check_transform("All(filter_read, ContentFilter('title', 'Title 1'))",
+                [ 0, 2, 4, 6 ])
+
+        self.check_transform("Any(StateFilter('-read'), ContentFilter('title', 'Title'))",
+                [ 1, 3, 5, 7, 9 ])
+
+        # Nested, the same as flat
+        self.check_transform("All(filter_read, All(ContentFilter('title', 'Title 1'), StateFilter('flag')))",
+                [ 0, 2, 4, 6 ])
+
+        # Filters work the same before or after a sort...
+        self.check_transform("All(sort_alphabetical, filter_read)", [ 8, 6, 4, 2, 0 ])
+        self.check_transform("All(filter_read, sort_alphabetical)", [ 8, 6, 4, 2, 0 ])
+
+        # ... but not a limit.
+        self.check_transform("All(ItemLimit(3), filter_read)", [ 0, 2 ])
+        self.check_transform("All(filter_read, ItemLimit(3))", [ 0, 2, 4 ])
+
+        # InTags depends on other tags, so it can't be run incrementally.
+        if is_filter(eval_transform("InTags('maintag:Test')")):
+            raise Exception("InTags is incremental")
+
+    def check_top(self):
+        self.banner("sort + limit")
+
+        self.check_transform("All(sort_alphabetical, ItemLimit(2))", [ 9, 8 ])
+        self.check_transform("All(filter_read, sort_alphabetical, ItemLimit(2))", [ 8, 6 ])
+
+        # Sort keys are remembered until the items change
+
+        top = eval_transform("All(sort_alphabetical, ItemLimit(2))")
+        got = top.transform(self.items[:], {})
+        if got != [ 9, 8 ]:
+            raise Exception("Bad sort from cached keys: %s" % got)
+
+        call_hook("daemon_items_changed", [ [ 9 ] ])
+        got = top.transform(self.items[:], { 9 : { "title" : "Title 99" } })
+        if got != [ 8, 7 ]:
+            raise Exception("Bad sort after change: %s" % got)
+
+        self.banner("sort ties")
+
+        # Ties go by id string, not handle.
+
+        b = allids.intern("http://b.example.com/", "1")
+        a = allids.intern("http://a.example.com/", "2")
+        c = allids.intern("http://c.example.com/", "0")
+        attrs = { a : { "title" : "Same" }, b : { "title" : "Same" },
+                c : { "title" : "Same" } }
+
+        for t, expected in [ ("sort_alphabetical", [ a, b, c ]),
+                ("All(sort_alphabetical, ItemLimit(1))", [ a ]),
+                ("All(sort_alphabetical, ItemLimit(2))", [ a, b ]) ]:
+            got = eval_transform(t).transform([ c, b, a ], attrs)
+            if got != expected:
+                raise Exception("%s - expected %s got %s" % (t, expected, got))
+
+    def check_sort_keys_threads(self):
+        self.banner("sort keys from several threads")
+
+        # Sorts outside tag_lock add to the cache while changed items are
+        # being forgotten.
+
+        errors = []
+
+        def forget():
+            try:
+                for i in range(2000):
+                    transform.forget_sort_keys(self.items)
+            except Exception as e:
+                errors.append(e)
+
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            t = Thread(target = forget)
+            t.start()
+            for i in range(2000):
+                attrs = dict([ (item, { "sort%d" % i : item }) for item in self.items ])
+                SortTransform("Sort %d" % i, "sort%d" % i).transform(self.items[:], attrs)
+            t.join()
+        finally:
+            sys.setswitchinterval(switch)
+
+        for i in range(2000):
+            transform.sort_keys.pop("sort%d" % i, None)
+
+        if errors:
+            raise Exception("Forgetting sort keys failed: %s" % errors)
+
+    def check_content(self):
+        self.banner("content filters")
+
+        self.check_transform("All(ContentFilter('title', 'Title 1'), ContentFilter('title', 'Title 2'))",
+                [ 0, 1, 2, 3, 4, 5, 6, 9 ])
+        self.check_transform("All(ContentFilter('title', 'Title 1'), ContentFilterRegex('title', 'Title [23]'))",
+                [ 0, 1, 2, 3, 4, 5, 9 ])
+
+        # Like the regexes they replace, only matches starting on the first
+        # line count.
+
+        attrs = { 0 : { "title" : "first\nsecond" },
+                  1 : { "title" : "first second" } }
+        for f, expected in [ ("ContentFilter('title', 'second')", [ 0 ]),
+                ("ContentFilter('title', 'first\\nsec')", [ 1 ]),
+                ("All(ContentFilter('title', 'second'), ContentFilter('title', 'x'))", [ 0 ]) ]:
+            got = eval_transform(f).transform([ 0, 1 ], attrs)
+            if got != expected:
+                raise Exception("%s - expected %s got %s" % (f, expected, got))
+
+    def check_search(self):
+        self.banner("search")
+
+        allsearch.clear()
+        allsearch.add_items(self.attrs)
+
+        self.check_transform("Search('title 3')", [ 6 ])
+        self.check_transform("Search('TITLE')", self.items)
+        self.check_transform("All(filter_read, Search('3'))", [ 6 ])
+        self.check_transform("Search('title 33')", [])
+
+    def check(self):
+        self.setup()
+        self.check_fused()
+        self.check_top()
+        self.check_sort_keys_threads()
+        self.check_content()
+        self.check_search()
+        return True
+
+TestTransform("transform")